@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+
+"""
+End-to-end Benchmark
+Downloads an album, a playlist and the liked songs from a local mock of the
+Web API and a stubbed content feeder serving synthetic Ogg Vorbis, then
+reports tracks per minute, bytes per second, per-stage latency percentiles
+and peak RSS. Every scenario runs in its own process with fresh folders, so
+nothing it does needs a Spotify account or network access.
+
+Usage: python benchmarks/bench_e2e.py [--tracks N] [--scenarios album playlist liked] [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from functools import partial
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("album", "playlist", "liked")
+RESULT_PREFIX = "BENCH-RESULT "
+
+
+def arguments(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="End-to-end download benchmark")
+    parser.add_argument("--tracks", type=int, default=24, help="tracks per scenario (default 24)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--workers", type=int, default=None, help="DOWNLOAD_WORKERS (default from env)")
+    parser.add_argument("--seconds", type=float, default=30, help="length of the synthetic track")
+    parser.add_argument("--bandwidth", type=float, default=8, help="stream bandwidth in MiB/s, 0 for unlimited")
+    parser.add_argument("--latency", type=float, default=100, help="stream open latency in ms")
+    parser.add_argument("--api-latency", type=float, default=20, help="Web API response latency in ms")
+    parser.add_argument("--raw", action="store_true", help="skip transcoding (implied without ffmpeg)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--run", choices=SCENARIOS, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+class StageTimer:
+    """ Thread-safe latency samples per stage """
+
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage: str, func):
+        """ Returns func, recording how long every call takes """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    @staticmethod
+    def percentile(samples: list, fraction: float) -> float:
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    def summary(self) -> dict:
+        """ Returns count, p50, p90, p99 and max in milliseconds per stage """
+        with self._lock:
+            return {stage: {'count': len(samples),
+                            'p50': self.percentile(samples, 0.50) * 1000,
+                            'p90': self.percentile(samples, 0.90) * 1000,
+                            'p99': self.percentile(samples, 0.99) * 1000,
+                            'max': max(samples) * 1000}
+                    for stage, samples in self.samples.items()}
+
+
+def peak_rss() -> (float, float):
+    """ Returns the peak RSS of this process and of its finished children, in MiB """
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def run_scenario(args: argparse.Namespace) -> dict:
+    """ Runs one scenario in this process and returns its measurements """
+    sys.path.insert(0, BENCH_PATH)
+    from mock_api import MockServer
+    from stubs import StubClient, StubContentFeeder, synthetic_ogg
+
+    payload = None if args.raw else synthetic_ogg(args.seconds, os.getenv("FFMPEG", "ffmpeg"))
+    raw = payload is None
+
+    with MockServer(args.tracks, latency=args.api_latency / 1000) as server:
+        # Configuration is read once on import, so it has to be in place first
+        workspace = tempfile.mkdtemp(prefix="zspotify-bench-")
+        os.environ["ROOT_PATH"] = os.path.join(workspace, "music")
+        os.environ["DATA_PATH"] = os.path.join(workspace, "data")
+        os.environ["SPOTIFY_API_URL"] = server.url
+        os.environ["OVERRIDE_AUTO_WAIT"] = "True"
+        os.environ["API_CACHE"] = "False"
+        os.environ["RAW_AUDIO_AS_IS"] = str(raw)
+        if args.workers:
+            os.environ["DOWNLOAD_WORKERS"] = str(args.workers)
+        sys.path.insert(0, os.path.join(BENCH_PATH, "..", "src"))
+
+        import cli
+        import spotify_api
+
+        timer = StageTimer()
+        feeder = StubContentFeeder(size=1024 * 1024 * 4, bandwidth=args.bandwidth * 1024 * 1024,
+                                   latency=args.latency / 1000, payload=payload)
+
+        class BenchSpotify(spotify_api.Spotify):
+            """ Spotify API that times every stage of a download """
+
+            def __init__(self, client):
+                super().__init__(client)
+                self._started = {}
+                self._api.get = timer.wrap("api", self._api.get)
+                self._artwork.get = timer.wrap("artwork", self._artwork.get)
+                self._download_audio = timer.wrap("stream", self._download_audio)
+                submit = self._post_processor.submit
+
+                def timed_submit(*submit_args, on_done=None, **kwargs):
+                    start = time.perf_counter()
+
+                    def done(error):
+                        timer.record("post-process", time.perf_counter() - start)
+                        on_done(error)
+                    return submit(*submit_args, on_done=done, **kwargs)
+                self._post_processor.submit = timed_submit
+
+            def download_track(self, track_id, output_dir="", *args, **kwargs):
+                self._started[(track_id, os.path.normpath(output_dir))] = time.perf_counter()
+                return super().download_track(track_id, output_dir, *args, **kwargs)
+
+            def _finish_track(self, track_ids, output_dir, *args, **kwargs):
+                start = self._started.pop((track_ids[0], os.path.normpath(output_dir)), None)
+                if start is not None:
+                    timer.record("track", time.perf_counter() - start)
+                return super()._finish_track(track_ids, output_dir, *args, **kwargs)
+
+        api = BenchSpotify(StubClient(feeder))
+        catalog = server.catalog
+        scenario = {
+            'album': partial(api.download_album, catalog.first_album),
+            'playlist': partial(api.download_playlist_songs, catalog.playlist['id'], catalog.playlist['name']),
+            'liked': partial(cli.liked_songs, api),
+        }[args.run]
+
+        start = time.perf_counter()
+        try:
+            scenario()
+            # Tracks aren't finished until their post-processing is
+            api._post_processor.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            api.close()
+
+        tracks = len(timer.samples.get("track", []))
+        rss, children_rss = peak_rss()
+        return {
+            'scenario': args.run,
+            'tracks': tracks,
+            'mode': "raw" if raw else spotify_api.env.MUSIC_FORMAT,
+            'workers': spotify_api.env.DOWNLOAD_WORKERS,
+            'seconds': elapsed,
+            'tracks_per_minute': tracks / elapsed * 60,
+            'bytes': feeder.served,
+            'bytes_per_second': feeder.served / elapsed,
+            'api_requests': server.requests,
+            'stages': timer.summary(),
+            'peak_rss_mib': rss,
+            'peak_child_rss_mib': children_rss,
+        }
+
+
+def spawn(args: argparse.Namespace, scenario: str) -> dict:
+    """ Runs a scenario in a fresh interpreter, so peak RSS and state are its own """
+    argv = [sys.executable, os.path.abspath(__file__), "--run", scenario, "--tracks", str(args.tracks),
+            "--seconds", str(args.seconds), "--bandwidth", str(args.bandwidth),
+            "--latency", str(args.latency), "--api-latency", str(args.api_latency)]
+    if args.workers:
+        argv += ["--workers", str(args.workers)]
+    if args.raw:
+        argv += ["--raw"]
+    result = subprocess.run(argv, stdout=subprocess.PIPE, text=True)
+    for line in reversed(result.stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"{scenario} scenario exited with {result.returncode} without a result")
+
+
+def report(results: list[dict]) -> None:
+    for result in results:
+        print(f"\n{result['scenario']}: {result['tracks']} tracks ({result['mode']}, "
+              f"{result['workers']} worker(s)) in {result['seconds']:.2f}s")
+        print(f"  {result['tracks_per_minute']:8.1f} tracks/min   "
+              f"{result['bytes_per_second'] / 1024 / 1024:6.2f} MiB/s   "
+              f"{result['api_requests']} API requests")
+        print(f"  peak RSS {result['peak_rss_mib']:.1f} MiB, "
+              f"children {result['peak_child_rss_mib']:.1f} MiB")
+        print(f"  {'stage':<14}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage, stats in result['stages'].items():
+            print(f"  {stage:<14}{stats['count']:>7}{stats['p50']:>10.1f}{stats['p90']:>10.1f}"
+                  f"{stats['p99']:>10.1f}{stats['max']:>10.1f}")
+
+
+def main():
+    args = arguments()
+    if args.run:
+        print(RESULT_PREFIX + json.dumps(run_scenario(args)))
+        return
+
+    results = [spawn(args, scenario) for scenario in args.scenarios]
+    report(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
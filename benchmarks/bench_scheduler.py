@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+
+"""
+Scheduler Benchmark
+Measures download_track throughput for a range of worker counts against a
+stubbed content feeder.
+
+Usage: python benchmarks/bench_scheduler.py [TRACKS] [WORKERS ...]
+"""
+import os
+import sys
+import time
+import tempfile
+
+os.environ.setdefault("ROOT_PATH", tempfile.mkdtemp(prefix="zspotify-bench-"))
+os.environ["RAW_AUDIO_AS_IS"] = "True"
+os.environ["OVERRIDE_AUTO_WAIT"] = "True"
+os.environ["SKIP_EXISTING_FILES"] = "False"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import spotify_api  # noqa: E402
+from stubs import StubClient, StubContentFeeder  # noqa: E402
+
+
+class BenchSpotify(spotify_api.Spotify):
+    """ Spotify API with canned metadata, so only the download path is measured """
+
+    def prefetch_song_info(self, song_ids):
+        pass
+
+    def get_song_info(self, song_id: str):
+        return (["Artist"], "Album", f"Track {song_id}", "", "2021", 1, 1, song_id, True)
+
+
+def run(tracks: int, workers: int, feeder: StubContentFeeder) -> float:
+    """ Downloads the given number of stub tracks, returns tracks per second """
+    spotify_api.env.DOWNLOAD_WORKERS = workers
+    api = BenchSpotify(StubClient(feeder))
+    jobs = [(f"{n:022d}", f"bench-{workers}") for n in range(tracks)]
+    start = time.perf_counter()
+    api.download_tracks(jobs, desc=f"{workers} worker(s)", total=tracks)
+    return tracks / (time.perf_counter() - start)
+
+
+def main():
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    worker_counts = [int(arg) for arg in sys.argv[2:]] or [1, 2, 4, 8]
+    feeder = StubContentFeeder()
+
+    results = [(workers, run(tracks, workers, feeder)) for workers in worker_counts]
+
+    baseline = results[0][1]
+    print(f"\n{tracks} tracks of {feeder.size / 1024 / 1024:.1f} MiB, "
+          f"{feeder.latency * 1000:.0f} ms open latency")
+    for workers, rate in results:
+        print(f"  {workers:>2} worker(s): {rate * 60:8.1f} tracks/min  ({rate / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
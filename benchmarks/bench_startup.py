@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+
+"""
+Startup Benchmark
+Measures how long modules take to import and how long a short invocation
+takes from a cold interpreter, against a budget so slow imports creeping back
+onto the startup path fail CI.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--check]
+"""
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Milliseconds on top of a bare interpreter start
+BUDGETS = {
+    "zspotify.py --help": 60,
+    "import cli": 15,
+    "import load_env": 150,
+    "import helpers": 160,
+    # What a short scripted single-track run pays before it can log in, mostly librespot and requests.
+    # Tight enough that pydub or music_tag (~130 ms) creeping back onto this path fails
+    "import auth": 320,
+    "import spotify_api": 340,
+}
+MODULES = ("cli", "load_env", "helpers", "metrics", "scheduler", "api_client", "auth", "spotify_api")
+
+
+def environment(root_path: str) -> dict:
+    python_path = os.pathsep.join(filter(None, [SRC_PATH, os.environ.get("PYTHONPATH")]))
+    return {**os.environ, "ROOT_PATH": root_path, "PYTHONPATH": python_path, "PYTHONDONTWRITEBYTECODE": "1"}
+
+
+def import_time(module: str, env: dict) -> float:
+    """ Returns the cumulative import time of a module in ms, from python -X importtime """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SRC_PATH, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    for line in reversed(result.stderr.splitlines()):
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+    raise RuntimeError(f"{module} missing from -X importtime output")
+
+
+def wall_time(argv: list, env: dict, runs: int) -> float:
+    """ Returns the median wall time of a command in ms """
+    import time
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, cwd=SRC_PATH, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="cold starts per command (default 5)")
+    parser.add_argument("--check", action="store_true", help="exit with 1 if a budget is exceeded")
+    args = parser.parse_args()
+
+    root_path = os.path.join(tempfile.mkdtemp(prefix="zspotify-bench-"), "music")
+    env = environment(root_path)
+    results = {}
+    failures = []
+
+    baseline = wall_time([sys.executable, "-c", "pass"], env, args.runs)
+    results["zspotify.py --help"] = wall_time(
+        [sys.executable, "zspotify.py", "--help"], env, args.runs) - baseline
+    for module in MODULES:
+        try:
+            results[f"import {module}"] = import_time(module, env)
+        except RuntimeError as error:
+            results[f"import {module}"] = None
+            print(f"  import {module} failed: {error}")
+
+    if os.path.exists(root_path):
+        failures.append("importing load_env created ROOT_PATH")
+
+    print(f"\nInterpreter start: {baseline:.1f} ms (subtracted from cold starts)")
+    for name, elapsed in results.items():
+        budget = BUDGETS.get(name)
+        if elapsed is None:
+            line = f"  {name:<24}   failed"
+            if budget is not None:
+                failures.append(f"{name} failed")
+        else:
+            line = f"  {name:<24}{elapsed:8.1f} ms"
+            if budget is not None:
+                line += f"   budget {budget} ms"
+                if elapsed > budget:
+                    line += "   OVER"
+                    failures.append(f"{name} took {elapsed:.1f} ms, budget {budget} ms")
+        print(line)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if args.check and failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#! /usr/bin/env python3
+
+"""
+Resume Check
+Kills a playlist download part way through and runs it again against the
+same job queue, failing unless the second run finishes the playlist without
+enumerating it from the Web API again. Like the benchmarks it runs against
+the local mock and stubs, without a Spotify account or network access.
+
+Usage: python benchmarks/check_resume.py [--tracks N]
+"""
+import os
+import sys
+import time
+import signal
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_PATH)
+
+from mock_api import MockServer  # noqa: E402
+
+
+def arguments(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Kill and resume a download")
+    parser.add_argument("--tracks", type=int, default=250, help="tracks in the playlist (default 250)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for each run")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def download_playlist() -> None:
+    """ Downloads the mock playlist, slowly enough to be killed part way through """
+    sys.path.insert(0, os.path.join(BENCH_PATH, "..", "src"))
+    from stubs import StubClient, StubContentFeeder
+    import spotify_api
+
+    feeder = StubContentFeeder(size=256 * 1024, bandwidth=1024 * 1024, latency=0.05)
+    api = spotify_api.Spotify(StubClient(feeder))
+    try:
+        api.download_playlist_songs(os.environ["RESUME_PLAYLIST_ID"], "Resume Playlist")
+        api._post_processor.join()
+    finally:
+        api.close()
+
+
+def job_state(path: str, key: str) -> (bool, int):
+    """ Returns whether the job is planned and how many of its items are done """
+    if not os.path.isfile(path):
+        return False, 0
+    db = sqlite3.connect(path)
+    try:
+        planned = db.execute("SELECT planned FROM jobs WHERE key = ?", (key,)).fetchone()
+        done = db.execute("SELECT COUNT(*) FROM items WHERE job_key = ? AND state = 'done'", (key,)).fetchone()[0]
+    except sqlite3.OperationalError:
+        return False, 0
+    finally:
+        db.close()
+    return bool(planned and planned[0]), done
+
+
+def main():
+    args = arguments()
+    if args.run:
+        download_playlist()
+        return
+
+    with MockServer(args.tracks, latency=0.01) as server:
+        workspace = tempfile.mkdtemp(prefix="zspotify-resume-")
+        playlist_id = server.catalog.playlist['id']
+        env = dict(os.environ,
+                   ROOT_PATH=os.path.join(workspace, "music"),
+                   DATA_PATH=os.path.join(workspace, "data"),
+                   SPOTIFY_API_URL=server.url,
+                   OVERRIDE_AUTO_WAIT="True",
+                   API_CACHE="False",
+                   RAW_AUDIO_AS_IS="True",
+                   RESUME_PLAYLIST_ID=playlist_id)
+        argv = [sys.executable, os.path.abspath(__file__), "--run"]
+        jobs_path = os.path.join(workspace, "data", "jobs.sqlite")
+        job_key = f"playlist:{playlist_id}"
+        enumerate_path = f"playlists/{playlist_id}/tracks"
+
+        # First run, killed a few downloads in
+        first = subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + args.timeout
+        done = 0
+        while done < 4 and time.monotonic() < deadline and first.poll() is None:
+            time.sleep(0.05)
+            _, done = job_state(jobs_path, job_key)
+        first.send_signal(signal.SIGKILL)
+        first.wait()
+        if not done:
+            sys.exit("FAIL: the first run didn't download anything")
+        if done >= args.tracks:
+            sys.exit("FAIL: the first run finished before it could be killed, use more --tracks")
+        print(f"killed after {done} of {args.tracks} track(s), "
+              f"{server.paths[enumerate_path]} page(s) of the playlist fetched")
+
+        # Second run, resuming from the job queue
+        enumerated = server.paths[enumerate_path]
+        subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, timeout=args.timeout, check=True)
+        enumerated = server.paths[enumerate_path] - enumerated
+        downloaded = sum(len(files) for _, _, files in os.walk(env["ROOT_PATH"]))
+        print(f"resumed: {enumerated} page(s) of the playlist fetched, {downloaded} track(s) on disk")
+
+        if enumerated:
+            sys.exit("FAIL: the resumed run enumerated the playlist again")
+        if downloaded != args.tracks:
+            sys.exit(f"FAIL: {downloaded} of {args.tracks} track(s) downloaded")
+        if job_state(jobs_path, job_key) != (False, 0):
+            sys.exit("FAIL: the finished job was left in the queue")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python3
+
+"""
+Session Pool Check
+Health checks a pool of stub sessions that share one token cache, the way
+librespot's sessions do, and fails unless only the session whose own
+credentials Spotify refuses is evicted.
+
+Usage: python benchmarks/check_sessions.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from auth import PooledSession, SessionPool  # noqa: E402
+
+
+class StubTokenProvider:
+    """ Cached tokens are always there, a fresh Login5 token only for accounts Spotify accepts """
+
+    def __init__(self, accepted: bool):
+        self.accepted = accepted
+        self.logins = 0
+
+    def get(self, scope: str) -> str:
+        return "shared-cached-token"
+
+    def login5(self, scopes: list):
+        self.logins += 1
+        return object() if self.accepted else None
+
+
+class StubSession:
+    def __init__(self, accepted: bool = True):
+        self._tokens = StubTokenProvider(accepted)
+        self.closed = False
+
+    def tokens(self) -> StubTokenProvider:
+        return self._tokens
+
+    def get_user_attribute(self, name: str) -> str:
+        return "premium"
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def main():
+    pool = SessionPool(StubSession())
+    healthy, refused = StubSession(), StubSession(accepted=False)
+    pool._sessions += [PooledSession("healthy.json", healthy), PooledSession("refused.json", refused)]
+
+    for _ in range(pool.max_failures):
+        pool.check()
+    stats = {account['name']: account for account in pool.stats()}
+    print(stats)
+
+    if not stats["refused.json"]['evicted'] or not refused.closed:
+        sys.exit("FAIL: the session Spotify refuses wasn't evicted")
+    if stats["healthy.json"]['evicted'] or stats["healthy.json"]['failures']:
+        sys.exit("FAIL: the healthy session was counted as failing")
+    if not healthy.tokens().logins:
+        sys.exit("FAIL: the healthy session was never checked with Spotify")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Mock Web API
+A local stand-in for the Spotify Web API endpoints spotify_api.py calls,
+serving a generated catalog so benchmarks run without network access.
+
+"""
+import json
+import time
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from stubs import synthetic_jpeg
+
+TRACKS_PER_ALBUM = 12
+
+
+def spotify_id(kind: str, n: int) -> str:
+    """ Returns a 22 character base62 ID, e.g. spotify_id('t', 7) for the 7th track """
+    return f"{kind}{n:021d}"
+
+
+class Catalog:
+    """ Generated artists, albums, tracks, playlists and liked songs """
+
+    def __init__(self, tracks: int, image_url: str):
+        self.artist = {'id': spotify_id('r', 0), 'name': "Benchmark Artist",
+                       'genres': ["benchmark"], 'followers': {'total': 0}}
+        self.albums = {}
+        self.tracks = {}
+        self.album_tracks = {}
+
+        for n in range(tracks):
+            album_id = spotify_id('a', n // TRACKS_PER_ALBUM)
+            if album_id not in self.albums:
+                self.albums[album_id] = {
+                    'id': album_id,
+                    'name': f"Album {len(self.albums) + 1}",
+                    'album_type': "album",
+                    'artists': [self.artist],
+                    'release_date': "2021-10-23",
+                    'images': [{'url': f"{image_url}/{album_id}.jpg", 'height': 640, 'width': 640}],
+                }
+                self.album_tracks[album_id] = []
+            album = self.albums[album_id]
+            track = {
+                'id': spotify_id('t', n),
+                'name': f"Track {n + 1}",
+                'artists': [self.artist],
+                'album': album,
+                'disc_number': 1,
+                'track_number': len(self.album_tracks[album_id]) + 1,
+                'is_playable': True,
+            }
+            self.tracks[track['id']] = track
+            self.album_tracks[album_id].append(track)
+        for album_id, album in self.albums.items():
+            album['total_tracks'] = len(self.album_tracks[album_id])
+
+        # One playlist and the liked songs hold every track, across all albums
+        self.playlist = {'id': spotify_id('p', 0), 'name': "Benchmark Playlist",
+                         'owner': {'display_name': "benchmark"}}
+        self.saved = list(self.tracks.values())
+
+    @property
+    def first_album(self) -> str:
+        return next(iter(self.albums))
+
+
+def page(items: list, query: dict) -> dict:
+    """ Returns one page of a paged endpoint """
+    limit = int(query.get('limit', ['20'])[0])
+    offset = int(query.get('offset', ['0'])[0])
+    return {'items': items[offset:offset + limit], 'total': len(items), 'limit': limit, 'offset': offset,
+            'next': None if offset + limit >= len(items) else f"?offset={offset + limit}&limit={limit}"}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ Routes Web API paths to the catalog """
+
+    server_version = "MockSpotify/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body, content_type: str = "application/json") -> None:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server: MockServer = self.server.mock
+        time.sleep(server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if parts and parts[0] == "v1":
+            parts = parts[1:]
+        server.count("/".join(parts))
+        catalog = server.catalog
+
+        if parts[0] == "images":
+            return self._send(200, server.cover, "image/jpeg")
+        if parts == ["tracks"]:
+            ids = query.get('ids', [""])[0].split(",")
+            return self._send(200, {'tracks': [catalog.tracks.get(track_id) for track_id in ids]})
+        if parts[0] == "albums" and len(parts) >= 2 and parts[1] in catalog.albums:
+            if len(parts) == 2:
+                return self._send(200, catalog.albums[parts[1]])
+            return self._send(200, page(catalog.album_tracks[parts[1]], query))
+        if parts[:1] == ["artists"] and parts[2:] == ["albums"]:
+            return self._send(200, page(list(catalog.albums.values()), query))
+        if parts[:2] == ["playlists", catalog.playlist['id']]:
+            if len(parts) == 2:
+                return self._send(200, catalog.playlist)
+            return self._send(200, page([{'track': track} for track in catalog.saved], query))
+        if parts == ["me", "tracks"]:
+            return self._send(200, page([{'track': track} for track in catalog.saved], query))
+        if parts == ["me", "playlists"]:
+            return self._send(200, page([catalog.playlist], query))
+        return self._send(404, {'error': {'status': 404, 'message': "Not found"}})
+
+
+class MockServer:
+    """ Mock Web API on a background thread """
+
+    def __init__(self, tracks: int, latency: float = 0.02, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency
+        self.requests = 0
+        # Requests per path, without the query
+        self.paths = Counter()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self.cover = synthetic_jpeg()
+        self.catalog = Catalog(tracks, self.url + "/images")
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-api", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.requests += 1
+            self.paths[path] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        return False
@@ -0,0 +1,142 @@
+"""
+Benchmark Stubs
+Stand-ins for the librespot session and content feeder, so download paths
+can be measured without a Spotify account or network access.
+
+"""
+import io
+import time
+import shutil
+import threading
+import subprocess
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+
+class StubAudioStream:
+    """ Readable stream that serves synthetic audio at a fixed bandwidth """
+
+    def __init__(self, size: int, bandwidth: float, payload: bytes = None, on_read=None):
+        self._size = size
+        self._bandwidth = bandwidth
+        self._payload = payload
+        self._on_read = on_read
+        self._position = 0
+
+    def read(self, amount: int) -> bytes:
+        amount = max(0, min(amount, self._size - self._position))
+        if self._bandwidth:
+            time.sleep(amount / self._bandwidth)
+        if self._payload is not None:
+            data = self._payload[self._position:self._position + amount]
+        else:
+            data = b"\0" * amount
+        self._position += amount
+        if self._on_read is not None:
+            self._on_read(amount)
+        return data
+
+    def seek(self, position: int) -> None:
+        self._position = position
+
+
+class StubInputStream:
+    """ Mirrors librespot's AbsChunkedInputStream wrapper """
+
+    def __init__(self, size: int, bandwidth: float, payload: bytes = None, on_read=None):
+        self.size = size
+        self._stream = StubAudioStream(size, bandwidth, payload, on_read)
+
+    def stream(self) -> StubAudioStream:
+        return self._stream
+
+
+class StubLoadedStream:
+    """ Result of a content feeder load """
+
+    def __init__(self, size: int, bandwidth: float, payload: bytes = None, on_read=None):
+        self.input_stream = StubInputStream(size, bandwidth, payload, on_read)
+
+
+class StubContentFeeder:
+    """ Serves synthetic streams after a fixed open latency """
+
+    def __init__(self, size: int = 4 * 1024 * 1024, bandwidth: float = 8 * 1024 * 1024,
+                 latency: float = 0.25, payload: bytes = None):
+        self.size = len(payload) if payload is not None else size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.payload = payload
+        self.loads = 0
+        self.served = 0
+        self._lock = threading.Lock()
+
+    def _served(self, amount: int) -> None:
+        with self._lock:
+            self.served += amount
+
+    def load(self, playable_id, audio_quality_picker, preload, halt_listener):
+        with self._lock:
+            self.loads += 1
+        time.sleep(self.latency)
+        return StubLoadedStream(self.size, self.bandwidth, self.payload, self._served)
+
+
+class StubSession:
+    """ Minimal librespot Session """
+
+    def __init__(self, feeder: StubContentFeeder):
+        self._feeder = feeder
+
+    def content_feeder(self) -> StubContentFeeder:
+        return self._feeder
+
+
+class StubClient:
+    """ Drop-in for auth.Client that never logs in """
+
+    def __init__(self, feeder: StubContentFeeder):
+        from librespot.audio.decoders import AudioQuality
+        self._session = StubSession(feeder)
+        self.is_premium = True
+        self.quality = AudioQuality.VERY_HIGH
+
+    def session(self) -> StubSession:
+        return self._session
+
+    @contextmanager
+    def lease(self):
+        yield SimpleNamespace(session=self._session, quality=self.quality)
+
+    @contextmanager
+    def session_errors(self, account):
+        yield
+
+    def user_read_email_token(self) -> str:
+        return "benchmark-token"
+
+    def refresh_token(self, scope: str = "user-read-email", stale: str = None) -> str:
+        return "benchmark-token"
+
+
+def synthetic_ogg(seconds: float = 30, ffmpeg: str = "ffmpeg") -> bytes:
+    """ Returns an Ogg Vorbis stream of a sine tone, or None without ffmpeg """
+    if shutil.which(ffmpeg) is None:
+        return None
+    source = ["-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={seconds}", "-ac", "2"]
+    # Not every ffmpeg build has libvorbis, the native encoder is good enough for a benchmark
+    for codec in (["-c:a", "libvorbis"], ["-c:a", "vorbis", "-strict", "experimental"]):
+        result = subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", *source, *codec,
+                                 "-b:a", "160k", "-f", "ogg", "pipe:1"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    return None
+
+
+def synthetic_jpeg(size: int = 640) -> bytes:
+    """ Returns a plain cover image """
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), (30, 215, 96)).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
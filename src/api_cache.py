@@ -0,0 +1,118 @@
+"""
+API Cache
+This file contains a persistent SQLite cache for Spotify Web API responses,
+so re-runs don't refetch track, album and playlist JSON that rarely changes.
+
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+from loguru import logger
+
+import load_env as env
+
+# Seconds a response stays fresh, first matching endpoint pattern wins
+TTLS = (
+    (re.compile(r"^tracks\b"), 30 * 24 * 3600),
+    (re.compile(r"^albums/"), 30 * 24 * 3600),
+    (re.compile(r"^episodes/"), 7 * 24 * 3600),
+    (re.compile(r"^artists/"), 24 * 3600),
+    (re.compile(r"^shows/"), 24 * 3600),
+    (re.compile(r"^search\b"), 3600),
+    (re.compile(r"^playlists/"), 15 * 60),
+    (re.compile(r"^me/"), 5 * 60),
+)
+
+
+class ApiCache:
+    """ Size-bounded SQLite store of decoded API responses """
+
+    def __init__(self, path: str, max_entries: int = None):
+        self.max_entries = max_entries or env.API_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " body TEXT NOT NULL,"
+            " expires REAL NOT NULL,"
+            " accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+
+    @staticmethod
+    def ttl(endpoint: str) -> int:
+        """ Returns how long responses of an endpoint may be cached, 0 if never """
+        endpoint = endpoint.lstrip("/")
+        for pattern, seconds in TTLS:
+            if pattern.search(endpoint):
+                return seconds
+        return 0
+
+    @staticmethod
+    def key(endpoint: str, params: dict = None) -> str:
+        """ Returns the cache key of an endpoint and its query parameters """
+        endpoint = endpoint.lstrip("/")
+        if not params:
+            return endpoint
+        query = "&".join(f"{name}={params[name]}" for name in sorted(params))
+        return f"{endpoint}?{query}"
+
+    def get(self, endpoint: str, params: dict = None):
+        """ Returns a fresh cached response or None """
+        key = self.key(endpoint, params)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body FROM responses WHERE key = ? AND expires > ?", (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, endpoint: str, params: dict, body) -> None:
+        """ Stores a response if its endpoint is cacheable """
+        ttl = self.ttl(endpoint)
+        if not ttl:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, body, expires, accessed) VALUES (?, ?, ?, ?)",
+                (self.key(endpoint, params), json.dumps(body), now + ttl, now))
+            self._inserts += 1
+            if self._inserts % 100 == 0:
+                self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float) -> None:
+        """ Drops expired rows, then the least recently used beyond max_entries """
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+        count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,))
+            logger.debug(f"API cache evicted {count - self.max_entries} response(s)")
+
+    def close(self) -> None:
+        """ Flushes and closes the cache database """
+        with self._lock:
+            self._evict(time.time())
+            self._db.commit()
+            self._db.close()
+        logger.debug(f"API cache: {self.hits} hit(s), {self.misses} miss(es)")
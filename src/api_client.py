@@ -0,0 +1,164 @@
+"""
+API Client
+This file contains the pooled HTTP client that every Spotify Web API call
+goes through.
+
+"""
+import os
+import time
+from email.utils import parsedate_to_datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from api_cache import ApiCache
+import load_env as env
+import metrics
+from ratelimit import RateLimiter
+
+
+class ApiClient:
+    """ Keep-alive HTTP client for Spotify's Web API """
+
+    def __init__(self, client):
+        self._client = client
+        self._session = requests.Session()
+
+        retries = Retry(
+            total=env.DEFAULT_RETRIES,
+            backoff_factor=env.RETRY_BACKOFF,
+            # 429s are left to the rate limiter, which slows every caller down rather than just this one
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=max(10, env.DOWNLOAD_WORKERS * 2),
+            max_retries=retries,
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # Shared by every caller for the whole run
+        self.limiter = RateLimiter("Web API", env.API_RATE, env.API_RATE_MAX)
+
+        self._cache = None
+        if env.API_CACHE:
+            self._cache = ApiCache(os.path.join(env.DATA_PATH, "api_cache.sqlite"))
+
+    @staticmethod
+    def url(endpoint: str) -> str:
+        """ Returns the full URL of an API endpoint such as 'tracks' or '/me/tracks' """
+        if endpoint.startswith("http://") or endpoint.startswith("https://"):
+            return endpoint
+        return env.SPOTIFY_API_URL.rstrip("/") + "/" + endpoint.lstrip("/")
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self._client.user_read_email_token()}"}
+
+    def get(self, endpoint: str, params: dict = None, bypass_cache: bool = False) -> dict:
+        """ Returns the decoded JSON body of an authenticated GET """
+        label = metrics.endpoint_label(endpoint) if metrics.enabled() else None
+        use_cache = self._cache is not None and not bypass_cache and not env.API_CACHE_BYPASS
+        if use_cache and (body := self._cache.get(endpoint, params)) is not None:
+            metrics.count("api_cache_hits", endpoint=label)
+            return body
+
+        with metrics.timer("api", endpoint=label):
+            response = self._request(endpoint, params)
+            if response.status_code == 401:
+                # The token expired under us, refresh it once and replay
+                metrics.count("retries", reason="token")
+                # Concurrent 401s share one refresh, later ones pick up the token it fetched
+                self._client.refresh_token(stale=response.request.headers.get("Authorization", "")[len("Bearer "):])
+                response = self._request(endpoint, params)
+            body = response.json()
+
+        # Bypassed requests still refresh the cache
+        if self._cache is not None and response.ok and "error" not in body:
+            self._cache.put(endpoint, params, body)
+        return body
+
+    @staticmethod
+    def _retry_after(response: requests.Response):
+        """ Returns the seconds a 429 asks us to wait, or None """
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _request(self, endpoint: str, params: dict = None) -> requests.Response:
+        for attempt in range(env.DEFAULT_RETRIES + 1):
+            self.limiter.acquire()
+            response = self._session.get(
+                self.url(endpoint), params=params, headers=self._headers(), timeout=env.HTTP_TIMEOUT)
+            # Retries urllib3 made on the way to this response
+            if metrics.enabled() and (retries := getattr(response.raw, "retries", None)) and retries.history:
+                metrics.count("retries", len(retries.history), reason="http")
+
+            if response.status_code == 429:
+                self.limiter.backoff(self._retry_after(response))
+                if attempt < env.DEFAULT_RETRIES:
+                    metrics.count("retries", reason="rate_limited")
+                    continue
+            elif response.status_code >= 500:
+                self.limiter.backoff()
+            else:
+                self.limiter.success()
+            return response
+
+    def iter_items(self, endpoint: str, params: dict = None, limit: int = 50, bypass_cache: bool = False):
+        """ Yields every item of a paged endpoint in order, as soon as its page arrives """
+        """ the first page's total decides which offsets are fetched concurrently """
+        params = dict(params or {})
+
+        def page(offset: int) -> dict:
+            return self.get(endpoint, params={**params, 'limit': limit, 'offset': offset},
+                            bypass_cache=bypass_cache)
+
+        first = page(0)
+        yield from first['items']
+
+        offsets = iter(range(limit, first.get('total') or 0, limit))
+        with ThreadPoolExecutor(max_workers=env.PAGINATION_WORKERS,
+                                thread_name_prefix="paginate") as executor:
+            # Only a bounded window of pages is in flight or waiting to be consumed
+            window = deque(executor.submit(page, offset)
+                           for offset in islice(offsets, env.PAGINATION_WORKERS))
+            try:
+                while window:
+                    resp = window.popleft().result()
+                    for offset in islice(offsets, 1):
+                        window.append(executor.submit(page, offset))
+                    yield from resp['items']
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def get_content(self, url: str, content_type: str = None) -> bytes:
+        """ Returns the raw body of an unauthenticated GET, e.g. cover artwork """
+        """ raises on an error status, or if the Content-Type doesn't start with content_type """
+        response = self._session.get(url, timeout=env.HTTP_TIMEOUT)
+        response.raise_for_status()
+        received = response.headers.get("Content-Type", "")
+        if content_type is not None and not received.startswith(content_type):
+            raise ValueError(f"{url} returned {received or 'no Content-Type'}, expected {content_type}")
+        content = response.content
+        metrics.count("bytes", len(content), stage="artwork")
+        return content
+
+    def close(self) -> None:
+        """ Closes every pooled connection and the response cache """
+        self._session.close()
+        if self._cache is not None:
+            self._cache.close()
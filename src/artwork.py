@@ -0,0 +1,148 @@
+"""
+Artwork Cache
+This file contains the cover artwork cache, an in-memory LRU in front of a
+content-addressed store on disk, so each cover is fetched once ever.
+
+"""
+import io
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from loguru import logger
+
+import load_env as env
+
+# Longest side in pixels and JPEG quality of each resize profile
+PROFILES = {
+    "original": None,
+    "large": (640, 90),
+    "small": (300, 85),
+}
+
+
+class ArtworkCache:
+    """ Cover artwork keyed by image URL, stored by content hash """
+
+    def __init__(self, fetch, path: str = None, profile: str = None, memory_items: int = None):
+        self.profile = profile or env.ARTWORK_PROFILE
+        if self.profile not in PROFILES:
+            raise ValueError(f"Unknown artwork profile '{self.profile}', use one of {', '.join(PROFILES)}")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._fetch = fetch
+        self._path = path or os.path.join(env.DATA_PATH, "artwork")
+        self._memory_items = memory_items or env.ARTWORK_MEMORY_ITEMS
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # One [lock, users] pair per URL, so concurrent tracks of an album fetch its cover once.
+        # A lock is only dropped by its last user, any later caller would otherwise get a lock of its own
+        self._url_locks = {}
+
+    def _index_path(self, url: str) -> str:
+        key = hashlib.sha1(f"{self.profile}:{url}".encode()).hexdigest()
+        return os.path.join(self._path, "index", key[:2], key)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self._path, "objects", digest[:2], digest + ".jpg")
+
+    def _remember(self, url: str, image: bytes) -> None:
+        with self._lock:
+            self._memory[url] = image
+            self._memory.move_to_end(url)
+            while len(self._memory) > self._memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, url: str) -> bytes:
+        """ Returns the artwork behind an image URL, or None if it couldn't be fetched """
+        with self._lock:
+            if url in self._memory:
+                self.memory_hits += 1
+                self._memory.move_to_end(url)
+                return self._memory[url]
+            entry = self._url_locks.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                with self._lock:
+                    if url in self._memory:
+                        self.memory_hits += 1
+                        return self._memory[url]
+
+                image = self._load(url)
+                if image is not None:
+                    with self._lock:
+                        self.disk_hits += 1
+                else:
+                    with self._lock:
+                        self.misses += 1
+                    try:
+                        image = self._resize(self._fetch(url))
+                    except Exception as error:
+                        # Nothing is stored, so a later track asks the CDN again
+                        logger.warning(f"Cover artwork {url} unavailable, tagging without it: {error}")
+                        image = None
+                    else:
+                        image = self._store(url, image)
+                if image is not None:
+                    self._remember(url, image)
+                return image
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._url_locks[url]
+
+    def _load(self, url: str):
+        """ Returns the stored artwork of a URL, or None """
+        try:
+            with open(self._index_path(url)) as index:
+                digest = index.read().strip()
+            with open(self._object_path(digest), "rb") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def _store(self, url: str, image: bytes) -> bytes:
+        """ Writes artwork under its content hash and points the URL at it """
+        if not image:
+            return image
+        digest = hashlib.sha256(image).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            self._write(object_path, image)
+        self._write(self._index_path(url), digest.encode())
+        return image
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    def _resize(self, image: bytes) -> bytes:
+        """ Applies the resize profile, leaving smaller images untouched """
+        if PROFILES[self.profile] is None or not image:
+            return image
+        from PIL import Image
+
+        size, quality = PROFILES[self.profile]
+        picture = Image.open(io.BytesIO(image))
+        if max(picture.size) > size:
+            picture.thumbnail((size, size))
+        output = io.BytesIO()
+        picture.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+    def stats(self) -> dict:
+        """ Returns the hit and miss counters """
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+    def close(self) -> None:
+        """ Logs the cache counters """
+        logger.debug(f"Artwork cache: {self.stats()}")
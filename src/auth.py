@@ -6,22 +6,304 @@ from Spotify.
 """
 
 import os
+import glob
+import json
+import time
+import sys
 import shutil
+import threading
+from contextlib import contextmanager
 from getpass import getpass
 from librespot.core import Session
 from librespot.audio.decoders import AudioQuality
+from loguru import logger
 import load_env as env
 
+# librespot's TokenProvider keeps one token list for every session in the process
+_PROVIDER_LOCK = threading.Lock()
+# Seconds between background token refresh attempts while they keep failing
+RETRY_MIN, RETRY_MAX = 1, 60
+
+
+class TokenManager:
+    """ Caches access tokens per scope and refreshes them before they lapse """
+
+    def __init__(self, session: Session, margin: int = None):
+        self.margin = env.TOKEN_REFRESH_MARGIN if margin is None else margin
+        self.refreshes = 0
+        self.failures = 0
+        self.refresh_seconds = 0.0
+        self.max_refresh_seconds = 0.0
+        self._session = session
+        # scope -> (access token, expiry as a time.time() timestamp)
+        self._tokens = {}
+        self._lock = threading.Lock()
+        # One refresh per scope at a time, the others wait for its token
+        self._refreshing = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+    def get(self, scope: str) -> str:
+        """ Returns a cached token for the scope, fetching one if there is none """
+        with self._lock:
+            token = self._tokens.get(scope)
+        if token is not None and token[1] > time.time():
+            return token[0]
+        return self.refresh(scope)
+
+    def refresh(self, scope: str, stale: str = None) -> str:
+        """ Fetches a new token for the scope, bypassing every cache """
+        """ stale is the token that was rejected, if another thread has replaced it already that's returned """
+        with self._lock:
+            refreshing = self._refreshing.setdefault(scope, threading.Lock())
+        with refreshing:
+            if stale is not None:
+                with self._lock:
+                    token = self._tokens.get(scope)
+                if token is not None and token[0] != stale and token[1] > time.time():
+                    return token[0]
+            return self._fetch(scope)
+
+    def _fetch(self, scope: str) -> str:
+        start = time.monotonic()
+        try:
+            provider = self._session.tokens()
+            if hasattr(provider, "login5"):
+                # Asks Login5 directly, leaving librespot's shared token list alone
+                token = provider.login5([scope])
+                if token is None:
+                    raise RuntimeError(f"Login5 returned no '{scope}' token")
+            else:
+                with _PROVIDER_LOCK:
+                    # librespot keeps its own cache and would hand back the token we want replaced
+                    cached = provider.find_token_with_all_scopes([scope])
+                    stored = getattr(provider, "_TokenProvider__tokens", None)
+                    if cached is not None and stored is not None:
+                        try:
+                            stored.remove(cached)
+                        except ValueError:
+                            pass
+                    token = provider.get_token(scope)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        elapsed = time.monotonic() - start
+
+        with self._lock:
+            self._tokens[scope] = (token.access_token, time.time() + token.expires_in)
+            self.refreshes += 1
+            self.refresh_seconds += elapsed
+            self.max_refresh_seconds = max(self.max_refresh_seconds, elapsed)
+        logger.debug(f"Refreshed '{scope}' token in {elapsed:.2f}s, valid for {token.expires_in}s")
+        return token.access_token
+
+    def start(self) -> None:
+        """ Starts refreshing cached tokens in the background """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_ahead, name="token-refresh", daemon=True)
+            self._thread.start()
+
+    def _refresh_ahead(self) -> None:
+        retry = RETRY_MIN
+        while not self._stop.is_set():
+            with self._lock:
+                tokens = dict(self._tokens)
+            now = time.time()
+            failed = False
+            for scope, (_, expires) in tokens.items():
+                if expires - now <= self.margin:
+                    try:
+                        self.refresh(scope)
+                    except Exception as error:
+                        failed = True
+                        logger.warning(f"Background refresh of '{scope}' token failed, retrying in {retry}s: {error}")
+            if failed:
+                # Doubles up to RETRY_MAX while Login5 keeps failing, rather than asking again every second
+                timeout = retry
+                retry = min(retry * 2, RETRY_MAX)
+            else:
+                retry = RETRY_MIN
+                with self._lock:
+                    next_due = min((expires for _, expires in self._tokens.values()), default=None)
+                # Wake up when the next token enters its margin, at least once a minute
+                timeout = 60 if next_due is None else min(60, max(1, next_due - self.margin - time.time()))
+            self._stop.wait(timeout)
+
+    def stats(self) -> dict:
+        """ Returns refresh counts and latencies """
+        with self._lock:
+            return {
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "mean_seconds": self.refresh_seconds / self.refreshes if self.refreshes else 0.0,
+                "max_seconds": self.max_refresh_seconds,
+            }
+
+    def close(self) -> None:
+        """ Stops the background refresh """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class PooledSession:
+    """ One logged in account of the session pool """
+
+    def __init__(self, name: str, session: Session):
+        self.name = name
+        self.session = session
+        self.is_premium = bool((session.get_user_attribute("type") == "premium") or env.FORCE_PREMIUM)
+        self.quality = AudioQuality.VERY_HIGH if self.is_premium else AudioQuality.HIGH
+        self.active = 0
+        self.assigned = 0
+        self.failures = 0
+        self.evicted = False
+
+
+class SessionPool:
+    """ Spreads downloads across several logged in accounts """
+
+    def __init__(self, primary: Session, credential_files: list[str] = None):
+        self.strategy = env.SESSION_POOL_STRATEGY
+        self.quota = env.SESSION_QUOTA
+        self.max_failures = env.SESSION_MAX_FAILURES
+        self._sessions = [PooledSession("credentials.json", primary)]
+        self._next = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+
+        for path in credential_files or []:
+            try:
+                self._sessions.append(PooledSession(os.path.basename(path), self._load(path)))
+            except Exception as error:
+                logger.warning(f"Could not log in with {path}: {error}")
+        if len(self._sessions) > 1:
+            logger.info(f"Session pool: {len(self._sessions)} accounts, {self.strategy}")
+
+    @staticmethod
+    def _load(path: str) -> Session:
+        """ Restores a session without overwriting the primary credentials.json """
+        conf = Session.Configuration.Builder().set_store_credentials(False).build()
+        return Session.Builder(conf).stored_file(path).create()
+
+    @property
+    def sessions(self) -> list[PooledSession]:
+        """ Returns the sessions that haven't been evicted """
+        with self._lock:
+            return [pooled for pooled in self._sessions if not pooled.evicted]
+
+    def _choose(self) -> PooledSession:
+        candidates = [pooled for pooled in self._sessions
+                      if not pooled.evicted and (not self.quota or pooled.assigned < self.quota)]
+        if not candidates:
+            raise RuntimeError("No healthy session with quota left in the pool")
+        if self.strategy == "round-robin":
+            pooled = candidates[self._next % len(candidates)]
+            self._next += 1
+            return pooled
+        return min(candidates, key=lambda pooled: (pooled.active, pooled.assigned))
+
+    @contextmanager
+    def lease(self):
+        """ Lends a session for one download """
+        with self._lock:
+            pooled = self._choose()
+            pooled.active += 1
+            pooled.assigned += 1
+        try:
+            yield pooled
+        finally:
+            with self._lock:
+                pooled.active -= 1
+
+    @contextmanager
+    def session_errors(self, pooled: PooledSession):
+        """ Counts errors raised in the block against the session, e.g. opening a stream """
+        """ encoder, disk and transfer errors happen outside it and say nothing about the account """
+        try:
+            yield
+        except Exception:
+            self._failed(pooled)
+            raise
+        with self._lock:
+            pooled.failures = 0
+
+    def _failed(self, pooled: PooledSession) -> None:
+        with self._lock:
+            pooled.failures += 1
+            # The primary session is never evicted, the Web API depends on it
+            if pooled.failures < self.max_failures or pooled is self._sessions[0] or pooled.evicted:
+                return
+            pooled.evicted = True
+        logger.warning(f"Evicting session {pooled.name} after {pooled.failures} failures in a row")
+        try:
+            pooled.session.close()
+        except Exception:
+            pass
+
+    def start(self) -> None:
+        """ Starts health checking the extra sessions in the background """
+        if len(self._sessions) > 1 and self._thread is None:
+            self._thread = threading.Thread(target=self._health_check, name="session-health", daemon=True)
+            self._thread.start()
+
+    def _health_check(self) -> None:
+        while not self._stop.wait(env.SESSION_HEALTH_INTERVAL):
+            self.check()
+
+    def check(self) -> None:
+        """ Asks Spotify for a token with each extra session's own credentials, counting refusals as failures """
+        for pooled in self.sessions[1:]:
+            try:
+                # tokens().get() would answer from the token cache librespot shares between sessions,
+                # login5 goes to Spotify as this account and keeps its connection warm
+                if pooled.session.tokens().login5(["user-read-email"]) is None:
+                    raise RuntimeError("Spotify refused to issue a token")
+            except Exception as error:
+                logger.warning(f"Health check of session {pooled.name} failed: {error}")
+                self._failed(pooled)
+            else:
+                with self._lock:
+                    pooled.failures = 0
+
+    def stats(self) -> list[dict]:
+        """ Returns per-account load counters """
+        with self._lock:
+            return [{"name": pooled.name, "assigned": pooled.assigned, "active": pooled.active,
+                     "failures": pooled.failures, "evicted": pooled.evicted}
+                    for pooled in self._sessions]
+
+    def close(self) -> None:
+        """ Stops health checks and closes the extra sessions """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for pooled in self._sessions[1:]:
+            if not pooled.evicted:
+                try:
+                    pooled.session.close()
+                except Exception:
+                    pass
+
 
 class Client:
     """ Client Authenticated by Spotify  """
     _session: Session  = None
+    _tokens: TokenManager = None
+    _pool: SessionPool = None
     is_premium: bool = False
     quality: AudioQuality = AudioQuality.HIGH
 
     def __init__(self):
         self._login()
         self._update_user_info()
+        self._tokens = TokenManager(self._session)
+        self._tokens.start()
+        self._pool = SessionPool(self._session, self._extra_credentials())
+        self._pool.start()
 
     # TODO: Pull in username and password from another method
     # Via Web Server possibly?
@@ -34,18 +316,40 @@ class Client:
             try:
                 self._session = Session.Builder().stored_file().create()
                 return
-            except RuntimeError:
-                pass
+            except RuntimeError as error:
+                logger.warning(f"Could not restore the session from credentials.json: {error}")
+        if not sys.stdin.isatty():
+            # Scripted runs fail straight away instead of waiting on a prompt nobody will answer
+            raise RuntimeError("No usable credentials.json and no terminal to log in from, "
+                               "log in interactively once to create it")
         while True:
             user_name = input("Username: ")
             password = getpass()
             try:
                 self._session = Session.Builder().user_pass(user_name, password).create()
-                shutil.copyfile('credentials.json','/config/credentials.json')
+                if os.path.isdir("/config"):
+                    shutil.copyfile('credentials.json','/config/credentials.json')
                 return
             except RuntimeError:
                 pass
 
+    @staticmethod
+    def _extra_credentials() -> list[str]:
+        """ Returns stored credential files of accounts other than the primary one """
+        if not env.CREDENTIALS_FILES:
+            return []
+
+        def username(path):
+            try:
+                with open(path) as file:
+                    return json.load(file).get("username")
+            except (OSError, ValueError):
+                return None
+
+        primary = username("credentials.json")
+        return [path for path in sorted(glob.glob(env.CREDENTIALS_FILES))
+                if username(path) is not None and username(path) != primary]
+
     def _update_user_info(self):
         self.is_premium = bool((self._session.get_user_attribute("type") == "premium") or env.FORCE_PREMIUM)
         if self.is_premium:
@@ -58,7 +362,30 @@ class Client:
         """ Returns Client Session """
         return self._session
 
+    def lease(self):
+        """ Lends a session from the pool for one download """
+        return self._pool.lease()
+
+    def session_errors(self, account):
+        """ Counts errors raised in the block against a leased account """
+        return self._pool.session_errors(account)
+
     def user_read_email_token(self):
         """ Returns the 'user-read-email' token for the client """
-        return self._session.tokens().get("user-read-email")
-    
+        return self._tokens.get("user-read-email")
+
+    def refresh_token(self, scope: str = "user-read-email", stale: str = None):
+        """ Replaces a token the API has rejected, stale being the rejected token """
+        return self._tokens.refresh(scope, stale)
+
+    def token_stats(self) -> dict:
+        """ Returns token refresh counts and latencies """
+        return self._tokens.stats()
+
+    def close(self):
+        """ Stops background work """
+        logger.debug(f"Token manager: {self._tokens.stats()}")
+        logger.debug(f"Session pool: {self._pool.stats()}")
+        self._tokens.close()
+        self._pool.close()
+
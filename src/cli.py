@@ -1,72 +1,121 @@
 """
 CLI Interface Handler
+Only the standard library is imported here, so arguments are checked before
+anything slow is imported or logged into.
 """
-from loguru import logger
-
-import spotify_api
-import helpers
+import sys
+
+# Annotations name spotify_api.Spotify as a string, importing it here would defeat the point
+
+COMMANDS = {
+    "search": "search",
+    "-p": "playlist",
+    "--playlist": "playlist",
+    "-ls": "liked_songs",
+    "--liked-songs": "liked_songs",
+    "-w": "web",
+    "--web": "web",
+    "-f": "file",
+    "--file": "file",
+    "-s": "sync",
+    "--sync": "sync",
+}
+
+
+def parse(args: list):
+    """ Returns the command args ask for, or None if there's nothing to log in for """
+    if len(args) < 2 or args[1] not in COMMANDS:
+        return None
+    if COMMANDS[args[1]] in ("search", "file") and len(args) < 3:
+        return None
+    return COMMANDS[args[1]]
+
+
+def usage(args: list) -> None:
+    """ Explains the arguments, pointing out an unknown one """
+    if len(args) > 1 and args[1] not in ("-h", "--help"):
+        unrecognized()
+    else:
+        show_help()
 
 
-def handle(api: spotify_api.Spotify, args: list) -> None:
+def handle(api: "spotify_api.Spotify", args: list) -> None:
     """ handles CLI input """
-    if args[1] == "search":
+    command = parse(args)
+    if command == "search":
         search_string(api, args)
-    elif args[1] == "-p" or args[1] == "--playlist":
+    elif command == "playlist":
         playlist(api)
-    elif args[1] == "-ls" or args[1] == "--liked-songs":
+    elif command == "liked_songs":
         liked_songs(api)
-    elif args[1] == "-w" or args[1] == "--web":
+    elif command == "web":
         web_server(api)
-    elif args[1] == "-h" or args[1] == "--help":
-        help()
+    elif command == "file":
+        bulk(api, args[2])
+    elif command == "sync":
+        sync(api, args[2:])
     else:
-        unrecognized()
+        usage(args)
 
 
-def playlist(api: spotify_api.Spotify):
+def playlist(api: "spotify_api.Spotify"):
     """ Downloads Users Playlists """
     api.download_from_user_playlist()
 
 
-def liked_songs(api: spotify_api.Spotify):
+def liked_songs(api: "spotify_api.Spotify"):
     """ Download Users Liked Songs """
-    for song in api.get_saved_tracks():
-        if not song['track']['name']:
-            print(
-                "###   SKIPPING:  SONG DOES NOT EXISTS ON SPOTIFY ANYMORE   ###")
-        else:
-            api.download_track(song['track']['id'], "Liked Songs/")
-        print("\n")
+    def jobs():
+        for song in api.iter_saved_tracks():
+            if not song['track']['name']:
+                print(
+                    "###   SKIPPING:  SONG DOES NOT EXISTS ON SPOTIFY ANYMORE   ###")
+            else:
+                yield song['track']['id'], "Liked Songs/"
 
+    # Downloads start as soon as the first page of liked songs arrives
+    api.download_tracks(jobs(), desc="Liked Songs", job_key="liked-songs")
 
-def web_server(api: spotify_api.Spotify):
+
+def web_server(api: "spotify_api.Spotify"):
     """ Runs a Web Server to Interact With """
-    logger.info("Please Implement Me :(")
+    import web_server as server
+    server.serve(api)
 
 
-def search_string(api: spotify_api.Spotify, args: list):
-    """ Searches Spotify with given term and Downloads """
-    track_id, album_id, playlist_id, episode_id, show_id, artist_id = helpers.regex_input_for_urls(args[2])
-
-    if track_id is not None:
-        api.download_track(track_id)
-    elif artist_id is not None:
-        api.download_artist_albums(artist_id)
-    elif album_id is not None:
-        api.download_album(album_id)
-    elif playlist_id is not None:
-        playlist_songs = api.get_playlist_songs(playlist_id)
-        name, _ = api.get_playlist_info(playlist_id)
-        for song in playlist_songs:
-            api.download_track(song['track']['id'],
-                               helpers.sanitize_data(name) + "/")
-            print("\n")
-    elif episode_id is not None:
-        api.download_episode(episode_id)
-    elif show_id is not None:
-        for episode in api.get_show_episodes(show_id):
-            api.download_episode(episode)
+def bulk(api: "spotify_api.Spotify", path: str):
+    """ Downloads every URI or URL listed in a file, or on stdin if path is - """
+    import helpers
+    if path == "-":
+        uris, invalid = helpers.read_uris(sys.stdin)
     else:
+        with open(path, encoding="utf-8-sig") as file:
+            uris, invalid = helpers.read_uris(file)
+    for line in invalid:
+        print("###   SKIPPING:", line, "(NOT A SPOTIFY URI OR URL)   ###")
+    print(f"\n  {len(uris)} unique link(s) to download\n")
+    api.download_uris(uris)
+
+
+def sync(api: "spotify_api.Spotify", args: list):
+    """ Syncs the given playlists, or every saved playlist, downloading only what changed """
+    import helpers
+    requested = [arg for arg in args if arg != "--prune"]
+    playlist_ids = []
+    for arg in requested:
+        parsed = helpers.parse_uri(arg)
+        if parsed is None or parsed[0] != "playlist":
+            print("###   SKIPPING:", arg, "(NOT A SPOTIFY PLAYLIST URI OR URL)   ###")
+        else:
+            playlist_ids.append(parsed[1])
+    if requested and not playlist_ids:
+        return
+    api.sync_playlists(playlist_ids, prune=True if "--prune" in args else None)
+
+
+def search_string(api: "spotify_api.Spotify", args: list):
+    """ Searches Spotify with given term and Downloads """
+    if not api.download_uri(args[2]):
         try:
             if len(args) > 3:
                 if args[2] == "artist":
@@ -81,8 +130,21 @@ def search_string(api: spotify_api.Spotify, args: list):
 
 def show_help():
     """ Displays Help """
+    print("""Usage:
+  zspotify.py search <url, uri or term>     Downloads a track, album, playlist, artist, episode or show, or searches for it
+  zspotify.py search artist <name>          Searches for an artist and downloads their albums
+  zspotify.py -p, --playlist                Downloads a saved playlist from your account
+  zspotify.py -ls, --liked-songs            Downloads all the liked songs from your account
+  zspotify.py -w, --web                     Accepts downloads over a local HTTP API on WEB_HOST:WEB_PORT
+  zspotify.py -f, --file <path or ->        Downloads every URI or URL listed in a file (or stdin), one per line, in one session
+  zspotify.py -s, --sync [playlists] [--prune]
+                                            Downloads what was added to the given playlists, or every saved playlist,
+                                            since the last sync, skipping unchanged ones; --prune deletes removed songs
+  zspotify.py -h, --help                    Shows this help
+""")
 
 
 def unrecognized():
     """ Displays Unkown Argument + Help """
+    print("###   UNKNOWN ARGUMENT   ###\n")
     show_help()
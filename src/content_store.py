@@ -0,0 +1,128 @@
+"""
+Content Store
+This file contains the store of canonical track files, one per track ID and
+format. Playlist, album and Liked Songs folders are filled with hardlinks,
+symlinks or M3U entries pointing into it, so a track shared by several
+playlists is downloaded, transcoded and stored once.
+
+"""
+import os
+import shutil
+import threading
+
+from loguru import logger
+
+import load_env as env
+
+LINK_MODES = ("off", "hardlink", "symlink", "m3u")
+
+
+class ContentStore:
+    """ Canonical track files keyed by track ID and format """
+
+    def __init__(self, path: str = None, mode: str = None):
+        self.mode = mode or env.LINK_MODE
+        if self.mode not in LINK_MODES:
+            raise ValueError(f"Unknown LINK_MODE '{self.mode}', use one of {', '.join(LINK_MODES)}")
+        self.root = path or env.STORE_PATH
+        self._lock = threading.Lock()
+        # Track ID -> Event set once the download producing its canonical file has ended
+        self._in_flight = {}
+        self._copy_warned = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def path(self, track_id: str, music_format: str = None) -> str:
+        """ Returns where a track's canonical file lives """
+        return os.path.join(self.root, track_id[:2], f"{track_id}.{music_format or env.MUSIC_FORMAT}")
+
+    def acquire(self, track_id: str) -> threading.Event:
+        """ Waits until no other download is producing the track's canonical file """
+        """ returns the claim to hand back to release() """
+        while True:
+            with self._lock:
+                if (pending := self._in_flight.get(track_id)) is None:
+                    claim = self._in_flight[track_id] = threading.Event()
+                    return claim
+            pending.wait()
+
+    def release(self, track_id: str, claim: threading.Event) -> None:
+        """ Lets the next download of the track go ahead, releasing twice does nothing """
+        with self._lock:
+            if self._in_flight.get(track_id) is claim:
+                del self._in_flight[track_id]
+        claim.set()
+
+    def materialize(self, canonical: str, target: str, output_dir: str) -> str:
+        """ Makes a canonical file show up as target, returns the path to record for the folder """
+        if self.mode == "m3u":
+            self._add_to_playlist(canonical, target, output_dir)
+            return canonical
+
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            if self.mode == "hardlink":
+                os.link(canonical, target)
+            else:
+                os.symlink(os.path.relpath(canonical, os.path.dirname(target)), target)
+        except OSError as error:
+            # e.g. the store and the folder are on different filesystems
+            if not self._copy_warned:
+                self._copy_warned = True
+                logger.warning(f"Could not {self.mode} into {os.path.dirname(target)}, copying instead: {error}")
+            shutil.copyfile(canonical, target)
+        return target
+
+    def remove(self, path: str, output_dir: str) -> None:
+        """ Takes a track out of a folder, the canonical file stays for the other folders """
+        root = os.path.abspath(self.root)
+        if os.path.commonpath([os.path.abspath(path), root]) == root:
+            self._remove_from_playlist(path, output_dir)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _playlist(output_dir: str) -> str:
+        """ Returns the M3U file standing in for a folder """
+        return os.path.join(env.ROOT_PATH, os.path.normpath(output_dir or "Tracks")) + ".m3u8"
+
+    def _add_to_playlist(self, canonical: str, target: str, output_dir: str) -> None:
+        """ Appends a track to the folder's M3U file instead of linking it """
+        playlist = self._playlist(output_dir)
+        entry = os.path.relpath(canonical, os.path.dirname(playlist))
+        title = os.path.splitext(os.path.basename(target))[0]
+        with self._lock:
+            os.makedirs(os.path.dirname(playlist) or ".", exist_ok=True)
+            existing = set()
+            if os.path.isfile(playlist):
+                with open(playlist, encoding="utf-8") as file:
+                    existing = {line.strip() for line in file}
+            if entry in existing:
+                return
+            with open(playlist, "a", encoding="utf-8") as file:
+                if not existing:
+                    file.write("#EXTM3U\n")
+                file.write(f"#EXTINF:-1,{title}\n{entry}\n")
+
+    def _remove_from_playlist(self, canonical: str, output_dir: str) -> None:
+        """ Drops a track and its #EXTINF line from the folder's M3U file """
+        playlist = self._playlist(output_dir)
+        entry = os.path.relpath(canonical, os.path.dirname(playlist))
+        with self._lock:
+            if not os.path.isfile(playlist):
+                return
+            with open(playlist, encoding="utf-8") as file:
+                lines = file.read().splitlines()
+            kept = []
+            for line in lines:
+                if line.strip() == entry:
+                    if kept and kept[-1].startswith("#EXTINF"):
+                        kept.pop()
+                    continue
+                kept.append(line)
+            with open(playlist, "w", encoding="utf-8") as file:
+                file.write("\n".join(kept) + "\n")
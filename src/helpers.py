@@ -2,15 +2,13 @@ import os
 import re
 import time
 import platform
-import requests
-
-import music_tag
-from pydub import AudioSegment
-from librespot.audio.decoders import AudioQuality
+import tempfile
+from contextlib import contextmanager
 
 import load_env as env
 
-requests.adapters.DEFAULT_RETRIES = env.DEFAULT_RETRIES
+# pydub, music_tag and librespot are imported where they're used, they take
+# longer to import than short runs like --help take altogether
 
 def splash():
     """ Displays splash screen """
@@ -54,17 +52,39 @@ def split_input(selection):
     return list(selection.strip().split(' '))
 
 
-def convert_audio_format(filename, quality):
+def chunks(iterable, size: int):
+    """ Yields lists of up to size items from any iterable """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def audio_bitrate(quality) -> str:
+    """ Returns the encoder bitrate for an audio quality """
+    from librespot.audio.decoders import AudioQuality
+    if quality == AudioQuality.VERY_HIGH:
+        return "320k"
+    return "160k"
+
+
+def convert_audio_format(filename, quality, tags: dict = None, artwork: bytes = None) -> bool:
     """ Converts raw audio into playable mp3 or ogg vorbis """
     """ quality is the audio quality output"""
+    """ returns True if the tags and artwork were written by the encoder """
     #print("###   CONVERTING TO " + MUSIC_FORMAT.upper() + "   ###")
+    from pydub import AudioSegment
     raw_audio = AudioSegment.from_file(filename, format="ogg",
                                        frame_rate=44100, channels=2, sample_width=2)
-    if quality == AudioQuality.VERY_HIGH:
-        bitrate = "320k"
-    else:
-        bitrate = "160k"
-    raw_audio.export(filename, format=env.MUSIC_FORMAT, bitrate=bitrate)
+    embed_artwork = bool(artwork) and encoder_embeds_artwork(env.MUSIC_FORMAT)
+    with artwork_file(artwork if embed_artwork else None) as cover:
+        raw_audio.export(filename, format=env.MUSIC_FORMAT, bitrate=audio_bitrate(quality),
+                         tags=encoder_metadata(tags) if tags else None, cover=cover)
+    return bool(tags) and (embed_artwork or not artwork)
 
 def convert_artist_format(artists):
     """ Returns converted artist format """
@@ -74,117 +94,109 @@ def convert_artist_format(artists):
     return formatted[:-2]
 
 
-# TODO: Change to Dict
-def set_audio_tags(filename, artists, name, album_name, release_year, disc_number, track_number, track_id_str):
-    """ sets music_tag metadata """
+# music_tag keys and the ffmpeg metadata keys they're written as
+ENCODER_TAGS = {
+    'artist': 'artist',
+    'tracktitle': 'title',
+    'album': 'album',
+    'year': 'date',
+    'discnumber': 'disc',
+    'tracknumber': 'track',
+    'comment': 'comment',
+}
+
+
+def track_tags(artists, name, album_name, release_year, disc_number, track_number, track_id_str) -> dict:
+    """ Returns a track's metadata record, keyed by music_tag names """
+    return {
+        'artist': convert_artist_format(artists),
+        'tracktitle': name,
+        'album': album_name,
+        'year': release_year,
+        'discnumber': disc_number,
+        'tracknumber': track_number,
+        'comment': 'id[spotify.com:track'+track_id_str+']',
+    }
+
+
+def encoder_metadata(tags: dict) -> dict:
+    """ Returns a metadata record as ffmpeg metadata """
+    return {ENCODER_TAGS[key]: str(value) for key, value in tags.items() if key in ENCODER_TAGS}
+
+
+def encoder_embeds_artwork(music_format: str) -> bool:
+    """ Returns True if ffmpeg can attach cover artwork while encoding this format """
+    return music_format == "mp3"
+
+
+@contextmanager
+def artwork_file(artwork: bytes = None):
+    """ Yields the path of a temporary copy of artwork, or None without artwork """
+    if not artwork:
+        yield None
+        return
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as file:
+        file.write(artwork)
+    try:
+        yield file.name
+    finally:
+        os.remove(file.name)
+
+
+def write_tags(filename, tags: dict, artwork: bytes = None):
+    """ Writes every tag and the cover artwork in a single load and save """
     #print("###   SETTING MUSIC TAGS   ###")
-    tags = music_tag.load_file(filename)
-    tags['artist'] = convert_artist_format(artists)
-    tags['tracktitle'] = name
-    tags['album'] = album_name
-    tags['year'] = release_year
-    tags['discnumber'] = disc_number
-    tags['tracknumber'] = track_number
-    tags['comment'] = 'id[spotify.com:track'+track_id_str+']'
-    tags.save()
-
-
-def set_music_thumbnail(filename, image_url):
-    """ Downloads cover artwork """
-    #print("###   SETTING THUMBNAIL   ###")
-    img = requests.get(image_url).content
-    tags = music_tag.load_file(filename)
-    tags['artwork'] = img
-    tags.save()
+    import music_tag
+    file_tags = music_tag.load_file(filename)
+    for key, value in tags.items():
+        file_tags[key] = value
+    if artwork:
+        file_tags['artwork'] = artwork
+    file_tags.save()
 
 
-def regex_input_for_urls(search_input):
-    """ What the fuck does this do? """
-    track_uri_search = re.search(
-        r"^spotify:track:(?P<TrackID>[0-9a-zA-Z]{22})$", search_input)
-    track_url_search = re.search(
-        r"^(https?://)?open\.spotify\.com/track/(?P<TrackID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-        search_input,
-    )
-
-    album_uri_search = re.search(
-        r"^spotify:album:(?P<AlbumID>[0-9a-zA-Z]{22})$", search_input)
-    album_url_search = re.search(
-        r"^(https?://)?open\.spotify\.com/album/(?P<AlbumID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-        search_input,
-    )
-
-    playlist_uri_search = re.search(
-        r"^spotify:playlist:(?P<PlaylistID>[0-9a-zA-Z]{22})$", search_input)
-    playlist_url_search = re.search(
-        r"^(https?://)?open\.spotify\.com/playlist/(?P<PlaylistID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-        search_input,
-    )
-
-    episode_uri_search = re.search(
-        r"^spotify:episode:(?P<EpisodeID>[0-9a-zA-Z]{22})$", search_input)
-    episode_url_search = re.search(
-        r"^(https?://)?open\.spotify\.com/episode/(?P<EpisodeID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-        search_input,
-    )
-
-    show_uri_search = re.search(
-        r"^spotify:show:(?P<ShowID>[0-9a-zA-Z]{22})$", search_input)
-    show_url_search = re.search(
-        r"^(https?://)?open\.spotify\.com/show/(?P<ShowID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-        search_input,
-    )
-
-    artist_uri_search = re.search(
-        r"^spotify:artist:(?P<ArtistID>[0-9a-zA-Z]{22})$", search_input)
-    artist_url_search = re.search(
-        r"^(https?://)?open\.spotify\.com/artist/(?P<ArtistID>[0-9a-zA-Z]{22})(\?si=.+?)?$",
-        search_input,
-    )
-
-    if track_uri_search is not None or track_url_search is not None:
-        track_id_str = (track_uri_search
-                        if track_uri_search is not None else
-                        track_url_search).group("TrackID")
-    else:
-        track_id_str = None
-
-    if album_uri_search is not None or album_url_search is not None:
-        album_id_str = (album_uri_search
-                        if album_uri_search is not None else
-                        album_url_search).group("AlbumID")
-    else:
-        album_id_str = None
+# Kinds of Spotify link, in the order regex_input_for_urls returns their IDs
+URI_KINDS = ("track", "album", "playlist", "episode", "show", "artist")
 
-    if playlist_uri_search is not None or playlist_url_search is not None:
-        playlist_id_str = (playlist_uri_search
-                           if playlist_uri_search is not None else
-                           playlist_url_search).group("PlaylistID")
-    else:
-        playlist_id_str = None
+# spotify:<kind>:<id> URIs and open.spotify.com/<kind>/<id> URLs in a single pass,
+# only URLs may carry a ?si= share suffix
+URI_PATTERN = re.compile(
+    r"^(?:spotify:(?P<uri_kind>track|album|playlist|episode|show|artist):"
+    r"|(?:https?://)?open\.spotify\.com/(?P<url_kind>track|album|playlist|episode|show|artist)/)"
+    r"(?P<id>[0-9a-zA-Z]{22})"
+    r"(?(url_kind)(?:\?si=.+?)?)$"
+)
 
-    if episode_uri_search is not None or episode_url_search is not None:
-        episode_id_str = (episode_uri_search
-                          if episode_uri_search is not None else
-                          episode_url_search).group("EpisodeID")
-    else:
-        episode_id_str = None
 
-    if show_uri_search is not None or show_url_search is not None:
-        show_id_str = (show_uri_search
-                       if show_uri_search is not None else
-                       show_url_search).group("ShowID")
-    else:
-        show_id_str = None
+def parse_uri(value: str):
+    """ Returns (kind, id) of a Spotify URI or URL, or None if it isn't one """
+    match = URI_PATTERN.match(value.strip())
+    if match is None:
+        return None
+    return match.group("uri_kind") or match.group("url_kind"), match.group("id")
 
-    if artist_uri_search is not None or artist_url_search is not None:
-        artist_id_str = (artist_uri_search
-                         if artist_uri_search is not None else
-                         artist_url_search).group("ArtistID")
-    else:
-        artist_id_str = None
 
-    return track_id_str, album_id_str, playlist_id_str, episode_id_str, show_id_str, artist_id_str
+def regex_input_for_urls(search_input):
+    """ Returns the track, album, playlist, episode, show and artist ID of a URI or URL, None for the others """
+    parsed = parse_uri(search_input)
+    return tuple(parsed[1] if parsed is not None and parsed[0] == kind else None for kind in URI_KINDS)
+
+
+def read_uris(lines) -> (list[tuple], list[str]):
+    """ Returns the unique (kind, id) pairs of URIs and URLs, one per line, and the lines that weren't one """
+    """ blank lines and lines starting with # are skipped """
+    uris = {}
+    invalid = []
+    for line in lines:
+        # A byte order mark left on by Notepad or a piped file, which strip() keeps
+        line = line.lstrip("\ufeff").strip()
+        if not line or line.startswith("#"):
+            continue
+        if (parsed := parse_uri(line)) is None:
+            invalid.append(line)
+        else:
+            uris.setdefault(parsed, None)
+    return list(uris), invalid
 
 
 def print_artist_list(artist_list: list[dict], start_index=0):
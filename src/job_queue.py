@@ -0,0 +1,204 @@
+"""
+Job Queue
+This file contains the persistent SQLite queue behind bulk downloads, so a
+crash or restart resumes a job exactly where it stopped without
+enumerating it from the API again.
+
+"""
+import os
+import time
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from loguru import logger
+
+import helpers
+
+# pending -> downloading -> (transcoding ->) done | failed
+STATES = ("pending", "downloading", "transcoding", "done", "failed")
+
+
+class JobQueue:
+    """ Expanded work lists of bulk jobs with a state per item """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        # Keys of jobs being run in this process, each job only runs once at a time
+        self._running = set()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Autocommit, transactions are opened explicitly where items are claimed or planned
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " key TEXT PRIMARY KEY,"
+            " planned INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            " job_key TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " track_id TEXT NOT NULL,"
+            " output_dir TEXT NOT NULL,"
+            " prefix INTEGER NOT NULL,"
+            " prefix_value TEXT NOT NULL,"
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (job_key, seq))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS items_state ON items (job_key, state, seq)")
+
+    @contextmanager
+    def _transaction(self):
+        """ Runs the block in an immediate transaction, rolling it back if the block raises """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    @contextmanager
+    def running(self, key: str):
+        """ Marks a job as being run, raising if another run of the same job hasn't finished """
+        with self._lock:
+            if key in self._running:
+                raise RuntimeError(f"Job {key} is already running")
+            self._running.add(key)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    @staticmethod
+    def _row(key: str, seq: int, job: tuple) -> tuple:
+        """ Returns an items row for a download_track argument tuple """
+        track_id, output_dir, prefix, prefix_value = (tuple(job) + ("", False, "")[len(job) - 1:])[:4]
+        return key, seq, track_id, output_dir, int(bool(prefix)), str(prefix_value), time.time()
+
+    def is_planned(self, key: str) -> bool:
+        """ Returns True if an earlier run finished enumerating the job's work list """
+        with self._lock:
+            row = self._db.execute("SELECT planned FROM jobs WHERE key = ?", (key,)).fetchone()
+        return bool(row and row[0])
+
+    def track(self, key: str, jobs):
+        """ Yields (seq, job) for every unfinished item of a job """
+        """ jobs is only enumerated when no earlier run finished planning the job """
+        """ callers hold running(key) for as long as the items are being worked on """
+        if self.is_planned(key):
+            with self._lock:
+                # Whatever was in flight when the last run died starts over, and what failed gets another go
+                # so this run's caller hears about it if it fails again
+                self._db.execute(
+                    "UPDATE items SET state = 'pending', updated = ? "
+                    "WHERE job_key = ? AND state IN ('downloading', 'transcoding', 'failed')", (time.time(), key))
+            logger.info(f"Resuming job {key}: {self.counts(key)}")
+            yield from self._unfinished(key)
+            return
+
+        # Planning runs on its own thread, so the whole work list is saved and the job marked planned
+        # as soon as jobs is exhausted, however far behind the downloads are
+        planned = queue.Queue()
+        threading.Thread(target=self._plan, args=(key, jobs, planned), name=f"plan-{key}", daemon=True).start()
+        while (rows := planned.get()) is not None:
+            if isinstance(rows, BaseException):
+                raise rows
+            for row in rows:
+                yield row[1], (row[2], row[3], bool(row[4]), row[5])
+
+    def _plan(self, key: str, jobs, planned: queue.Queue) -> None:
+        """ Saves a job's work list 100 items at a time, handing each saved batch to planned """
+        """ followed by None once the job is planned, or by the exception that stopped it """
+        try:
+            with self._transaction():
+                self._db.execute("DELETE FROM items WHERE job_key = ?", (key,))
+                self._db.execute("INSERT OR REPLACE INTO jobs (key, planned, created) VALUES (?, 0, ?)",
+                                 (key, time.time()))
+
+            seq = 0
+            for batch in helpers.chunks(jobs, 100):
+                rows = []
+                for job in batch:
+                    rows.append(self._row(key, seq, job))
+                    seq += 1
+                with self._transaction():
+                    self._db.executemany(
+                        "INSERT INTO items (job_key, seq, track_id, output_dir, prefix, prefix_value, updated)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                planned.put(rows)
+
+            with self._lock:
+                self._db.execute("UPDATE jobs SET planned = 1 WHERE key = ?", (key,))
+            logger.debug(f"Job {key} planned: {seq} items")
+            self._complete_if_finished(key)
+        except BaseException as error:
+            planned.put(error)
+            return
+        planned.put(None)
+
+    def _unfinished(self, key: str, page: int = 500):
+        """ Yields pending items in order, a page at a time """
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT seq, track_id, output_dir, prefix, prefix_value FROM items "
+                    "WHERE job_key = ? AND state = 'pending' AND seq > ? ORDER BY seq LIMIT ?",
+                    (key, last, page)).fetchall()
+            if not rows:
+                return
+            for seq, track_id, output_dir, prefix, prefix_value in rows:
+                yield seq, (track_id, output_dir, bool(prefix), prefix_value)
+            last = rows[-1][0]
+
+    def claim(self, key: str, seq: int) -> bool:
+        """ Marks a pending item as downloading, returns False if someone else has it """
+        with self._transaction():
+            claimed = self._db.execute(
+                "UPDATE items SET state = 'downloading', attempts = attempts + 1, updated = ? "
+                "WHERE job_key = ? AND seq = ? AND state = 'pending'", (time.time(), key, seq)).rowcount
+        return claimed == 1
+
+    def set_state(self, key: str, seq: int, state: str, error=None) -> None:
+        """ Moves an item to a new state """
+        if state not in STATES:
+            raise ValueError(f"Unknown job item state '{state}'")
+        with self._lock:
+            self._db.execute(
+                "UPDATE items SET state = ?, error = ?, updated = ? WHERE job_key = ? AND seq = ?",
+                (state, None if error is None else str(error), time.time(), key, seq))
+        if state in ("done", "failed"):
+            self._complete_if_finished(key)
+
+    def counts(self, key: str) -> dict:
+        """ Returns the number of items of a job in each state """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT state, COUNT(*) FROM items WHERE job_key = ? GROUP BY state", (key,)).fetchall()
+        return dict(rows)
+
+    def _complete_if_finished(self, key: str) -> None:
+        """ Forgets a fully planned job once every item is done or failed """
+        with self._transaction():
+            planned = self._db.execute("SELECT planned FROM jobs WHERE key = ?", (key,)).fetchone()
+            open_items = self._db.execute(
+                "SELECT COUNT(*) FROM items WHERE job_key = ? AND state NOT IN ('done', 'failed')",
+                (key,)).fetchone()[0]
+            finished = bool(planned and planned[0]) and open_items == 0
+            if finished:
+                self._db.execute("DELETE FROM items WHERE job_key = ?", (key,))
+                self._db.execute("DELETE FROM jobs WHERE key = ?", (key,))
+        if finished:
+            logger.debug(f"Job {key} finished")
+
+    def close(self) -> None:
+        """ Closes the queue database """
+        with self._lock:
+            self._db.close()
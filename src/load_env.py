@@ -1,8 +1,16 @@
 import os
-from distutils.util import strtobool
-from dotenv import load_dotenv
+from dotenv import find_dotenv, load_dotenv
 from loguru import logger
 
+def strtobool(value: str) -> bool:
+    """ distutils.util.strtobool without importing distutils """
+    value = value.strip().lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError(f"invalid truth value {value!r}")
+
 def is_docker():
     path = '/proc/self/cgroup'
     return (
@@ -10,22 +18,32 @@ def is_docker():
         os.path.isfile(path) and any('docker' in line for line in open(path))
     )
 
-if not is_docker():
+# The cgroup scan only matters, and only runs, when there is a .env file to load
+if (dotenv_path := find_dotenv()) and not is_docker():
     logger.info("Loading .env File")
-    load_dotenv()
+    load_dotenv(dotenv_path)
 
 # READ ENV
 DEBUG = bool(strtobool(os.getenv("DEBUG", "False")))
 
 # Download Paths
+# Created by the first download rather than on import
 ROOT_PATH = os.getenv("ROOT_PATH", "/download/zspotify_music")
-if not os.path.exists(ROOT_PATH):
-    os.makedirs(ROOT_PATH)
 
 ROOT_PODCAST_PATH = "zspotify_podcasts/" # TODO: Is this right?
 
+# Databases and caches kept between runs
+DATA_PATH = os.getenv("DATA_PATH", os.path.join(ROOT_PATH, ".zspotify"))
+
 SKIP_EXISTING_FILES = bool(strtobool(os.getenv("SKIP_EXISTING_FILES", "True")))
 
+# Keeps one canonical file per track and format in STORE_PATH, and fills playlist, album and
+# Liked Songs folders with a hardlink, symlink or m3u entry to it. off downloads into each folder
+LINK_MODE = os.getenv("LINK_MODE", "off").lower()
+STORE_PATH = os.getenv("STORE_PATH", os.path.join(ROOT_PATH, ".store"))
+# Lets --sync delete songs that were removed from a playlist since its last sync, same as --prune
+SYNC_PRUNE = bool(strtobool(os.getenv("SYNC_PRUNE", "False")))
+
 # set to True if not detecting your premium account automaticalllyg
 FORCE_PREMIUM = bool(strtobool(os.getenv("FORCE_PREMIUM", "False")))
 RAW_AUDIO_AS_IS = bool(strtobool(os.getenv('RAW_AUDIO_AS_IS', "False")))
@@ -35,16 +53,84 @@ MUSIC_FORMAT = os.getenv('MUSIC_FORMAT', "mp3")
 if RAW_AUDIO_AS_IS:
     MUSIC_FORMAT = "wav"
 
-# This is how many seconds ZSpotify waits between downloading tracks so
-# spotify doesn't get out the ban hammer
-ANTI_BAN_WAIT_TIME = int(os.getenv("ANTI_BAN_WAIT_TIME", "5"))
-ANTI_BAN_WAIT_TIME_ALBUMS = int(os.getenv("ANTI_BAN_WAIT_TIME_ALBUMS", "30"))
-# Set this to True to not wait at all between tracks and just go balls to the wall
+# Pipe audio into ffmpeg while it downloads instead of converting it afterwards
+STREAM_TRANSCODE = bool(strtobool(os.getenv("STREAM_TRANSCODE", "True")))
+FFMPEG = os.getenv("FFMPEG", "ffmpeg")
+# Cover artwork: original, large (640px) or small (300px), and covers kept in memory
+ARTWORK_PROFILE = os.getenv("ARTWORK_PROFILE", "original")
+ARTWORK_MEMORY_ITEMS = int(os.getenv("ARTWORK_MEMORY_ITEMS", "64"))
+# Processes used to transcode and tag finished downloads, 0 uses every core
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "0"))
+
+# Web API calls and stream opens per second, so spotify doesn't get out the ban hammer.
+# They start at the first value, ramp up to the MAX while Spotify is happy and back off on 429s and errors
+API_RATE = float(os.getenv("API_RATE", "10"))
+API_RATE_MAX = float(os.getenv("API_RATE_MAX", "50"))
+STREAM_RATE = float(os.getenv("STREAM_RATE", "1"))
+STREAM_RATE_MAX = float(os.getenv("STREAM_RATE_MAX", "5"))
+RATE_LIMIT_MIN = float(os.getenv("RATE_LIMIT_MIN", "0.1"))
+# Calls/s added for every healthy second, and what the rate is multiplied by on a 429 or error
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", "0.1"))
+RATE_LIMIT_DECREASE = float(os.getenv("RATE_LIMIT_DECREASE", "0.5"))
+RATE_LIMIT_LOG_INTERVAL = int(os.getenv("RATE_LIMIT_LOG_INTERVAL", "60"))
+# Set this to True to not rate limit at all and just go balls to the wall
 OVERRIDE_AUTO_WAIT = bool(strtobool(os.getenv("OVERRIDE_AUTO_WAIT", "False")))
 
+# Release groups downloaded for an artist: album, single, compilation, appears_on
+ARTIST_ALBUM_GROUPS = os.getenv("ARTIST_ALBUM_GROUPS", "album,single,compilation")
+
+# Number of tracks downloaded at the same time over the shared session
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+# Attempts per track, retries wait TRACK_RETRY_DELAY * 2 ** (attempt - 1) seconds (jittered, capped)
+TRACK_RETRIES = int(os.getenv("TRACK_RETRIES", "5"))
+TRACK_RETRY_DELAY = float(os.getenv("TRACK_RETRY_DELAY", "5"))
+TRACK_RETRY_DELAY_MAX = float(os.getenv("TRACK_RETRY_DELAY_MAX", "300"))
+# Tracks that failed every attempt are appended here
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", os.path.join(DATA_PATH, "dead_letters.jsonl"))
+
 CHUNK_SIZE = 50000
+# Bytes received between updates of a .part file's resume sidecar
+PART_STATE_INTERVAL = 1024 * 1024
 LIMIT = 50
+# Maximum number of IDs the Web API accepts in one /v1/tracks request
+METADATA_BATCH_SIZE = 50
 DEFAULT_RETRIES = 10
+# Seconds between retries grow as RETRY_BACKOFF * 2 ** (retry - 1)
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", "0.5"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "30"))
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+# Pages of a paged endpoint fetched at the same time once its total is known
+PAGINATION_WORKERS = int(os.getenv("PAGINATION_WORKERS", "8"))
+
+# Glob of extra stored credential files, e.g. /config/accounts/*.json, to download with more accounts
+CREDENTIALS_FILES = os.getenv("CREDENTIALS_FILES", "")
+# least-loaded or round-robin
+SESSION_POOL_STRATEGY = os.getenv("SESSION_POOL_STRATEGY", "least-loaded")
+# Tracks each account downloads per run, 0 for no limit
+SESSION_QUOTA = int(os.getenv("SESSION_QUOTA", "0"))
+SESSION_MAX_FAILURES = int(os.getenv("SESSION_MAX_FAILURES", "3"))
+SESSION_HEALTH_INTERVAL = int(os.getenv("SESSION_HEALTH_INTERVAL", "300"))
+
+# Seconds before expiry at which access tokens are refreshed in the background
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+# Caches Web API responses on disk, set API_CACHE_BYPASS to always refetch
+API_CACHE = bool(strtobool(os.getenv("API_CACHE", "True")))
+API_CACHE_BYPASS = bool(strtobool(os.getenv("API_CACHE_BYPASS", "False")))
+API_CACHE_MAX_ENTRIES = int(os.getenv("API_CACHE_MAX_ENTRIES", "100000"))
+
+# Local job API started with --web
+WEB_HOST = os.getenv("WEB_HOST", "127.0.0.1")
+WEB_PORT = int(os.getenv("WEB_PORT", "8080"))
+# Jobs run at the same time, each still downloads on DOWNLOAD_WORKERS threads
+WEB_JOB_WORKERS = int(os.getenv("WEB_JOB_WORKERS", "2"))
+# Finished jobs GET /jobs still lists, older ones are forgotten
+WEB_JOB_HISTORY = int(os.getenv("WEB_JOB_HISTORY", "1000"))
+
+# Records per-stage timings and counters, appended to METRICS_FILE and served on METRICS_PORT if set
+METRICS = bool(strtobool(os.getenv("METRICS", "False")))
+METRICS_FILE = os.getenv("METRICS_FILE", os.path.join(DATA_PATH, "metrics.jsonl"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 # if DEBUG:
 #     logger.info("DEBUG Mode Started")
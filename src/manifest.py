@@ -0,0 +1,79 @@
+"""
+Download Manifest
+This file contains the SQLite record of every finished download, keyed by
+Spotify track ID, so skip decisions don't need any network calls.
+
+"""
+import os
+import time
+import sqlite3
+import threading
+
+
+class DownloadManifest:
+    """ Record of finished downloads keyed by track ID, format and output folder """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            " track_id TEXT NOT NULL,"
+            " format TEXT NOT NULL,"
+            " output_dir TEXT NOT NULL,"
+            " path TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " completed REAL NOT NULL,"
+            " PRIMARY KEY (track_id, format, output_dir))")
+        self._db.commit()
+
+    @staticmethod
+    def _folder(output_dir: str) -> str:
+        return os.path.normpath(output_dir or ".")
+
+    def get(self, track_id: str, music_format: str, output_dir: str = ""):
+        """ Returns the recorded output path of a track in a folder, or None """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT path, size FROM downloads WHERE track_id = ? AND format = ? AND output_dir = ?",
+                (track_id, music_format, self._folder(output_dir))).fetchone()
+        if row is None:
+            return None
+        path, size = row
+        # Only trust the record while the file is still there and complete
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return None
+        return path
+
+    def contains(self, track_id: str, music_format: str, output_dir: str = "") -> bool:
+        """ Returns True if the track has a complete download in the folder """
+        return self.get(track_id, music_format, output_dir) is not None
+
+    def record(self, track_ids, music_format: str, output_dir: str, path: str) -> None:
+        """ Records a finished download under every ID it is known by """
+        if isinstance(track_ids, str):
+            track_ids = [track_ids]
+        size = os.path.getsize(path)
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO downloads (track_id, format, output_dir, path, size, completed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(track_id, music_format, self._folder(output_dir), os.path.abspath(path), size, now)
+                 for track_id in dict.fromkeys(track_ids)])
+            self._db.commit()
+
+    def forget(self, track_id: str, music_format: str, output_dir: str = "") -> None:
+        """ Removes a track's record from a folder """
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM downloads WHERE track_id = ? AND format = ? AND output_dir = ?",
+                (track_id, music_format, self._folder(output_dir)))
+            self._db.commit()
+
+    def close(self) -> None:
+        """ Closes the manifest database """
+        with self._lock:
+            self._db.close()
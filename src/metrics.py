@@ -0,0 +1,216 @@
+"""
+Metrics
+This file contains the per-stage timing and counters of downloads, exported
+as Prometheus text and as a JSON-lines file. Until enable() is called every
+function here returns straight away, so instrumented code pays next to
+nothing when metrics are off.
+
+"""
+import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+from loguru import logger
+
+import load_env as env
+
+# Upper bounds in seconds of the stage duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PREFIX = "zspotify_"
+
+_DISABLED = nullcontext()
+_registry = None
+_server = None
+
+
+class Histogram:
+    """ Cumulative bucket counts, sum and count of one labelled stage """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        for n, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[n] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Registry:
+    """ Stage durations and counters keyed by name and labels """
+
+    def __init__(self, path: str = None):
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._counters = {}
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def _log(self, record: dict) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+
+    def observe(self, stage: str, seconds: float, **labels) -> None:
+        """ Records one run of a stage """
+        with self._lock:
+            key = self._key(stage, labels)
+            if (histogram := self._durations.get(key)) is None:
+                histogram = self._durations[key] = Histogram()
+            histogram.observe(seconds)
+            self._log({"ts": time.time(), "stage": stage, "seconds": seconds, **labels})
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        """ Adds to a counter such as bytes, retries or errors """
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._log({"ts": time.time(), "counter": name, "value": value, **labels})
+
+    @contextmanager
+    def time(self, stage: str, **labels):
+        """ Times the block as a stage, counting an error if it raises """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.count("errors", stage=stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: dict = None) -> str:
+        pairs = list(labels) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                   for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        """ Returns every metric in the Prometheus text exposition format """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            durations = {key: (list(h.buckets), h.sum, h.count) for key, h in self._durations.items()}
+            counters = dict(self._counters)
+
+        lines = [f"# HELP {PREFIX}stage_duration_seconds Time spent in each download stage",
+                 f"# TYPE {PREFIX}stage_duration_seconds histogram"]
+        for (stage, labels), (buckets, total, count) in sorted(durations.items()):
+            labels = (("stage", stage),) + labels
+            for bound, observed in zip(BUCKETS, buckets):
+                lines.append(f"{PREFIX}stage_duration_seconds_bucket"
+                             f"{self._labels(labels, {'le': bound})} {observed}")
+            lines.append(f"{PREFIX}stage_duration_seconds_bucket{self._labels(labels, {'le': '+Inf'})} {count}")
+            lines.append(f"{PREFIX}stage_duration_seconds_sum{self._labels(labels)} {total}")
+            lines.append(f"{PREFIX}stage_duration_seconds_count{self._labels(labels)} {count}")
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{PREFIX}{name}_total{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        """ Flushes and closes the JSON-lines file """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def enabled() -> bool:
+    """ Returns True once metrics are being recorded """
+    return _registry is not None
+
+
+def timer(stage: str, **labels):
+    """ Context manager timing a stage """
+    if _registry is None:
+        return _DISABLED
+    return _registry.time(stage, **labels)
+
+
+def observe(stage: str, seconds: float, **labels) -> None:
+    """ Records a stage timed elsewhere, e.g. in a worker process """
+    if _registry is not None:
+        _registry.observe(stage, seconds, **labels)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    """ Adds to a counter """
+    if _registry is not None:
+        _registry.count(name, value, **labels)
+
+
+def endpoint_label(endpoint: str) -> str:
+    """ Returns an API endpoint with its IDs masked, e.g. 'albums/:id/tracks' """
+    path = re.sub(r"^https?://[^/]+(/v1)?", "", endpoint).strip("/")
+    return re.sub(r"(?<=/)[0-9a-zA-Z]{22}(?=/|$)", ":id", "/" + path)[1:]
+
+
+def render() -> str:
+    """ Returns the Prometheus text of everything recorded so far """
+    return _registry.render() if _registry is not None else ""
+
+
+def enable(path: str = None, port: int = None) -> None:
+    """ Starts recording, appending to a JSON-lines file and serving /metrics if given """
+    global _registry, _server
+    if _registry is None:
+        _registry = Registry(path)
+    if port and _server is None:
+        # Only imported when serving, it's slow enough to show up in the startup budget
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                data = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        _server = ThreadingHTTPServer((env.WEB_HOST, port), Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Metrics on http://{_server.server_address[0]}:{_server.server_address[1]}/metrics")
+
+
+def start() -> None:
+    """ Enables metrics if the environment asks for them """
+    if env.METRICS:
+        enable(env.METRICS_FILE or None, env.METRICS_PORT or None)
+
+
+def close() -> None:
+    """ Stops serving and flushes the JSON-lines file """
+    global _registry, _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+    if _registry is not None:
+        _registry.close()
+        _registry = None
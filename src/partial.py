@@ -0,0 +1,86 @@
+"""
+Partial Downloads
+This file contains the .part file handling that lets interrupted transfers
+resume from their last chunk and only moves finished files into place.
+
+"""
+import os
+import json
+
+import load_env as env
+
+
+class PartialDownload:
+    """ Download written to a .part file, with a sidecar recording bytes received """
+
+    def __init__(self, filename: str, total_size: int, resumable: bool = True):
+        self.filename = filename
+        self.total_size = total_size
+        self.part_path = filename + ".part"
+        self.state_path = filename + ".part.json"
+        self.received = self._resume_offset() if resumable else 0
+        self.offset = self.received
+        self._file = None
+        self._unsaved = 0
+
+    def _resume_offset(self) -> int:
+        """ Returns how many bytes of a previous attempt can be kept """
+        try:
+            with open(self.state_path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return 0
+        if state.get("total") != self.total_size or not os.path.isfile(self.part_path):
+            return 0
+        return min(int(state.get("bytes", 0)), os.path.getsize(self.part_path))
+
+    def __enter__(self):
+        self._file = open(self.part_path, "r+b" if self.offset else "wb")
+        self._file.seek(self.offset)
+        self._file.truncate()
+        return self
+
+    def write(self, chunk: bytes) -> int:
+        """ Appends a chunk, saving progress every few chunks """
+        written = self._file.write(chunk)
+        self.received += written
+        self._unsaved += written
+        if self._unsaved >= env.PART_STATE_INTERVAL:
+            self._save()
+        return written
+
+    def _save(self) -> None:
+        self._file.flush()
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"bytes": self.received, "total": self.total_size}, file)
+        os.replace(temp_path, self.state_path)
+        self._unsaved = 0
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._save()
+        self._file.close()
+        self._file = None
+        return False
+
+    def complete(self) -> bool:
+        """ Returns True once every byte of the stream is on disk """
+        return self.received >= self.total_size and os.path.getsize(self.part_path) >= self.total_size
+
+    def seal(self) -> None:
+        """ Drops the sidecar before the .part file is converted or tagged in place """
+        """ after that its bytes are no longer the stream's, so a later run starts over """
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def finalize(self) -> None:
+        """ Atomically moves the finished file into place """
+        os.replace(self.part_path, self.filename)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def discard(self) -> None:
+        """ Removes the .part file and its sidecar """
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
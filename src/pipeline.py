@@ -0,0 +1,95 @@
+"""
+Post-Processing Pipeline
+This file contains the transcode and tagging stage, which runs on a pool of
+worker processes so CPU-heavy encodes never hold up the next download.
+
+"""
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from loguru import logger
+
+import helpers
+import load_env as env
+import metrics
+
+
+def post_process(filename, quality, transcode: bool, tags: dict, artwork: bytes) -> dict:
+    """ Converts and tags a finished download, runs inside a worker process """
+    """ returns the seconds spent in each stage, for the parent to record """
+    timings = {}
+    embedded = False
+    if transcode:
+        start = time.perf_counter()
+        embedded = helpers.convert_audio_format(filename, quality, tags, artwork)
+        timings['transcode'] = time.perf_counter() - start
+    if not embedded:
+        start = time.perf_counter()
+        helpers.write_tags(filename, tags, artwork)
+        timings['tag'] = time.perf_counter() - start
+    return timings
+
+
+class PostProcessor:
+    """ Queue of finished downloads consumed by a pool of transcode workers """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or env.TRANSCODE_WORKERS or os.cpu_count() or 1
+        self.processed = 0
+        self.failed = 0
+        self._executor: ProcessPoolExecutor = None
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    @property
+    def backlog(self) -> int:
+        """ Number of downloads waiting for or going through post-processing """
+        return len(self._futures)
+
+    def submit(self, filename: str, quality, transcode: bool, tags: dict, artwork: bytes, on_done=None):
+        """ Queues a finished download, on_done(error) is called once it's processed """
+        with self._lock:
+            if self._executor is None:
+                # Spawned rather than forked, download threads may be holding locks
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            future = self._executor.submit(post_process, filename, quality, transcode, tags, artwork)
+            self._futures.add(future)
+        logger.debug(f"Transcode backlog: {self.backlog}")
+        future.add_done_callback(lambda done: self._finished(done, on_done))
+        return future
+
+    def _finished(self, future, on_done) -> None:
+        error = future.exception()
+        with self._lock:
+            self._futures.discard(future)
+            if error is None:
+                self.processed += 1
+            else:
+                self.failed += 1
+        if error is None:
+            for stage, seconds in future.result().items():
+                metrics.observe(stage, seconds)
+        else:
+            metrics.count("errors", stage="post_process")
+        if on_done is not None:
+            on_done(error)
+
+    def join(self) -> None:
+        """ Waits until the backlog is empty """
+        with self._lock:
+            pending = list(self._futures)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} track(s) to finish post-processing")
+            wait(pending)
+
+    def close(self) -> None:
+        """ Drains the backlog and stops the worker processes """
+        self.join()
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -0,0 +1,106 @@
+"""
+Rate Limiter
+This file contains the adaptive token bucket that paces Web API calls and
+stream opens. It speeds up additively while Spotify answers normally and
+halves its rate on 429s and errors, instead of sleeping a fixed time per track.
+
+"""
+import time
+import threading
+
+from loguru import logger
+
+import load_env as env
+import metrics
+
+
+class RateLimiter:
+    """ Token bucket with an additive-increase, multiplicative-decrease rate """
+
+    def __init__(self, name: str, rate: float, max_rate: float, min_rate: float = None,
+                 increase: float = None, decrease: float = None, enabled: bool = None):
+        self.name = name
+        self.max_rate = max_rate
+        self.min_rate = min_rate or env.RATE_LIMIT_MIN
+        self.rate = min(max(rate, self.min_rate), max_rate)
+        self.increase = env.RATE_LIMIT_INCREASE if increase is None else increase
+        self.decrease = decrease or env.RATE_LIMIT_DECREASE
+        self.enabled = not env.OVERRIDE_AUTO_WAIT if enabled is None else enabled
+        self.waited = 0.0
+        self.backoffs = 0
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        # Nothing is let through before this, set from Retry-After
+        self._paused_until = 0.0
+        self._decreased = 0.0
+        self._logged = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ Blocks until the next call may go out """
+        if not self.enabled:
+            # Pacing is off, but a Retry-After still has to be waited out
+            with self._lock:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    self.waited += delay
+            if delay > 0:
+                time.sleep(delay)
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    # Up to a second's worth of calls may go out back to back
+                    self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+    def success(self) -> None:
+        """ Speeds up after a healthy response, by about increase calls/s every second """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+            self._log(time.monotonic())
+
+    def backoff(self, retry_after: float = None) -> None:
+        """ Slows down after a 429 or an error, pausing for retry_after seconds if given """
+        """ with pacing turned off only the pause applies """
+        metrics.count("rate_limited", limiter=self.name)
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+                self._tokens = 0.0
+                self._updated = self._paused_until
+            if not self.enabled:
+                if retry_after:
+                    logger.warning(f"{self.name} rate limited, pausing for {retry_after:g}s")
+                return
+            # Concurrent failures from the same moment only count once
+            if now - self._decreased < 1.0:
+                return
+            self._decreased = now
+            self.backoffs += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        logger.warning(f"{self.name} rate limited, slowing down to {self.rate:.2f}/s"
+                       + (f" after a {retry_after:g}s pause" if retry_after else ""))
+
+    def _log(self, now: float) -> None:
+        if now - self._logged >= env.RATE_LIMIT_LOG_INTERVAL:
+            self._logged = now
+            logger.info(f"{self.name} rate {self.rate:.2f}/s, waited {self.waited:.1f}s, "
+                        f"{self.backoffs} backoff(s)")
+
+    def stats(self) -> dict:
+        """ Returns the current rate and how much it has held things up """
+        with self._lock:
+            return {"rate": self.rate, "waited_seconds": self.waited, "backoffs": self.backoffs}
@@ -0,0 +1,227 @@
+"""
+Download Scheduler
+This file contains a bounded worker pool that runs download jobs
+concurrently over the shared librespot session, retrying failed jobs with
+backoff while the others keep going.
+
+"""
+import time
+import heapq
+import random
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait
+
+from loguru import logger
+
+import load_env as env
+import metrics
+
+
+class Job:
+    """ A submitted call, its attempts so far and what to do if it never succeeds """
+
+    def __init__(self, func, args: tuple, kwargs: dict, key=None, on_failure=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key if key is not None else (args[0] if args else None)
+        self.on_failure = on_failure
+        self.attempts = 0
+
+
+class DownloadScheduler:
+    """ Runs download jobs on a bounded pool of worker threads """
+
+    def __init__(self, workers: int = None, desc: str = None, total: int = None, unit: str = 'Song',
+                 status=None, listener=None, attempts: int = None):
+        self.workers = max(1, workers or env.DOWNLOAD_WORKERS)
+        self.attempts = max(1, attempts or env.TRACK_RETRIES)
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        # Jobs that failed every attempt, as dicts of key, attempts and last error,
+        # plus a stage of post_process for ones whose transcode or tagging failed
+        self.dead_letters = []
+        self._desc = desc
+        self._total = total
+        self._unit = unit
+        # Optional callable returning extra counters to show next to the progress bar
+        self._status = status
+        # Optional callable told listener(completed, failed) whenever a job finishes
+        self._listener = listener
+        self._executor: ThreadPoolExecutor = None
+        self._progress = None
+        # (future, job) in submission order, so progress is reported in order
+        self._pending = deque()
+        # (due, seq, job) heap of failed jobs waiting out their backoff
+        self._delayed = []
+        self._sequence = itertools.count()
+        # Bounds the number of queued + running jobs
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._cancelled = threading.Event()
+        # Finished jobs whose track is still being transcoded or tagged, guards the counters too
+        self._processing = 0
+        self._processed = threading.Condition()
+
+    def __enter__(self):
+        from tqdm import tqdm
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="download")
+        self._progress = tqdm(desc=self._desc, total=self._total,
+                              unit=self._unit, unit_scale=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.join()
+            else:
+                self.cancel()
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._progress.close()
+        return False
+
+    @property
+    def cancelled(self) -> bool:
+        """ Returns True once the scheduler has been cancelled """
+        return self._cancelled.is_set()
+
+    def submit(self, func, *args, key=None, on_failure=None, **kwargs):
+        """ Queues a job, blocking while the pool is saturated """
+        """ on_failure(error) is called if the job still fails after its last attempt """
+        if self.cancelled:
+            return None
+        future = self._start(Job(func, args, kwargs, key, on_failure))
+        self._drain(block=False)
+        return future
+
+    def job_state(self, key, forward=None):
+        """ Returns a state(name, error=None) callback for one job's download_track, passing it on to forward """
+        """ join() waits for jobs that are still post-processing, and one that fails there is a dead letter """
+        processing = False
+
+        def state(name: str, error=None) -> None:
+            nonlocal processing
+            if forward is not None:
+                forward(name, error)
+            with self._processed:
+                if name == "transcoding" and not processing:
+                    processing = True
+                    self._processing += 1
+                elif name in ("done", "failed") and processing:
+                    processing = False
+                    self._processing -= 1
+                    self._processed.notify_all()
+                if name == "failed":
+                    # The download itself succeeded and was counted as completed
+                    self.completed -= 1
+                    self.failed += 1
+                    self.dead_letters.append(
+                        {'key': key, 'attempts': 1, 'error': str(error), 'stage': 'post_process'})
+                    completed, failed = self.completed, self.failed
+            if name == "failed":
+                metrics.count("errors", stage="job")
+                if self._listener is not None:
+                    self._listener(completed, failed)
+
+        return state
+
+    def join(self) -> None:
+        """ Waits for every queued job, including retries and post-processing, to finish """
+        self._drain(block=True)
+        with self._processed:
+            if self._processing and not self.cancelled:
+                logger.info(f"Waiting for {self._processing} track(s) to finish post-processing")
+            self._processed.wait_for(lambda: self._processing == 0 or self.cancelled)
+
+    def cancel(self) -> None:
+        """ Stops starting new jobs and drops everything still queued """
+        if self.cancelled:
+            return
+        self._cancelled.set()
+        dropped = sum(1 for future, _ in self._pending if future.cancel()) + len(self._delayed)
+        self._delayed.clear()
+        logger.warning(f"Download cancelled, dropped {dropped} queued job(s)")
+
+    def _start(self, job: Job):
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, job)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append((future, job))
+        return future
+
+    def _run(self, job: Job):
+        if self.cancelled:
+            raise CancelledError()
+        job.attempts += 1
+        return job.func(*job.args, **job.kwargs)
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """ Returns the delay before the next attempt, half fixed and half random """
+        delay = min(env.TRACK_RETRY_DELAY_MAX, env.TRACK_RETRY_DELAY * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _retry_due(self) -> None:
+        """ Puts failed jobs whose backoff has passed back on the pool """
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now and not self.cancelled:
+            _, _, job = heapq.heappop(self._delayed)
+            self._start(job)
+
+    def _drain(self, block: bool) -> None:
+        """ Reports finished jobs in the order they were submitted """
+        while True:
+            self._retry_due()
+            if self._pending and self._pending[0][0].done():
+                self._finished(*self._pending.popleft())
+                continue
+            if not block or self.cancelled:
+                return
+            timeout = max(0.0, self._delayed[0][0] - time.monotonic()) if self._delayed else None
+            if self._pending:
+                wait([self._pending[0][0]], timeout=timeout)
+            elif self._delayed:
+                self._cancelled.wait(timeout)
+            else:
+                return
+
+    def _finished(self, future, job: Job) -> None:
+        try:
+            future.result()
+        except CancelledError:
+            return
+        except Exception as error:
+            if job.attempts < self.attempts and not self.cancelled:
+                delay = self._backoff(job.attempts)
+                self.retried += 1
+                metrics.count("retries", reason="job")
+                logger.warning(f"Download job {job.key} failed (attempt {job.attempts} of {self.attempts}), "
+                               f"retrying in {delay:.1f}s: {error}")
+                heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._sequence), job))
+                return
+            with self._processed:
+                self.failed += 1
+                self.dead_letters.append({'key': job.key, 'attempts': job.attempts, 'error': str(error)})
+            metrics.count("errors", stage="job")
+            logger.error(f"Download job {job.key} failed after {job.attempts} attempt(s): {error}")
+            if job.on_failure is not None:
+                job.on_failure(error)
+        else:
+            with self._processed:
+                self.completed += 1
+        if self._status is not None:
+            self._progress.set_postfix(self._status(), refresh=False)
+        self._progress.update(1)
+        if self._listener is not None:
+            self._listener(self.completed, self.failed)
@@ -0,0 +1,66 @@
+"""
+Playlist Snapshots
+This file contains the SQLite record of each synced playlist's snapshot_id
+and track list, so a sync can skip playlists that haven't changed and only
+download what was added to the others.
+
+"""
+import os
+import time
+import sqlite3
+import threading
+
+
+class PlaylistSnapshots:
+    """ Last synced snapshot_id, folder and track IDs of each playlist """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS playlists ("
+            " playlist_id TEXT PRIMARY KEY,"
+            " snapshot_id TEXT,"
+            " name TEXT NOT NULL,"
+            " output_dir TEXT NOT NULL,"
+            " synced REAL NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS playlist_tracks ("
+            " playlist_id TEXT NOT NULL,"
+            " track_id TEXT NOT NULL,"
+            " PRIMARY KEY (playlist_id, track_id))")
+        self._db.commit()
+
+    def get(self, playlist_id: str):
+        """ Returns the (snapshot_id, output_dir) of the last sync, or None """
+        with self._lock:
+            return self._db.execute(
+                "SELECT snapshot_id, output_dir FROM playlists WHERE playlist_id = ?",
+                (playlist_id,)).fetchone()
+
+    def tracks(self, playlist_id: str) -> set[str]:
+        """ Returns the track IDs the playlist had at its last sync """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT track_id FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,)).fetchall()
+        return {track_id for track_id, in rows}
+
+    def save(self, playlist_id: str, snapshot_id, name: str, output_dir: str, track_ids) -> None:
+        """ Replaces the playlist's record, a None snapshot_id makes the next sync compare tracks again """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO playlists (playlist_id, snapshot_id, name, output_dir, synced)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (playlist_id, snapshot_id, name, output_dir, time.time()))
+                self._db.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+                self._db.executemany(
+                    "INSERT INTO playlist_tracks (playlist_id, track_id) VALUES (?, ?)",
+                    [(playlist_id, track_id) for track_id in dict.fromkeys(track_ids)])
+
+    def close(self) -> None:
+        """ Closes the snapshot database """
+        with self._lock:
+            self._db.close()
@@ -5,132 +5,299 @@ This file contains methods to interact with Spotify's API.
 """
 import os
 import re
-import time
 import json
-import requests
+import hashlib
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
-from tqdm import tqdm
 from librespot.metadata import TrackId, EpisodeId
 from librespot.audio.decoders import VorbisOnlyAudioQuality
 from loguru import logger
 
 import helpers
+from api_client import ApiClient
+from artwork import ArtworkCache
 from auth import Client
+from content_store import ContentStore
+from job_queue import JobQueue
+from manifest import DownloadManifest
+from partial import PartialDownload
+from pipeline import PostProcessor
+from ratelimit import RateLimiter
+from scheduler import DownloadScheduler
+from snapshots import PlaylistSnapshots
+from transcode import StreamingEncoder
 import load_env as env
-
-requests.adapters.DEFAULT_RETRIES = env.DEFAULT_RETRIES
+import metrics
 
 
 class Spotify():
     """ Class to interace with Spotify API """
     _client: Client = None
+    _api: ApiClient = None
+    _manifest: DownloadManifest = None
+    _post_processor: PostProcessor = None
+    _artwork: ArtworkCache = None
+    _jobs: JobQueue = None
+    _stream_limiter: RateLimiter = None
+    _store: ContentStore = None
+    _snapshots: PlaylistSnapshots = None
 
     def __init__(self, client: Client):
         self._client = client
+        self._api = ApiClient(client)
+        self._manifest = DownloadManifest(os.path.join(env.DATA_PATH, "manifest.sqlite"))
+        self._post_processor = PostProcessor()
+        self._artwork = ArtworkCache(partial(self._api.get_content, content_type="image/"))
+        self._jobs = JobQueue(os.path.join(env.DATA_PATH, "jobs.sqlite"))
+        self._store = ContentStore()
+        self._snapshots = PlaylistSnapshots(os.path.join(env.DATA_PATH, "playlists.sqlite"))
+        # Paces stream opens across every worker and account for the whole run
+        self._stream_limiter = RateLimiter("Stream", env.STREAM_RATE, env.STREAM_RATE_MAX)
+        # Song metadata resolved ahead of download_track, keyed by track ID
+        self._song_info = {}
+        # Per-thread progress listeners, so concurrent callers each hear about their own downloads
+        self._listeners = threading.local()
+
+    def close(self) -> None:
+        """ Releases connections and flushes caches """
+        self._post_processor.close()
+        self._artwork.close()
+        self._api.close()
+        self._manifest.close()
+        self._jobs.close()
+        self._snapshots.close()
+
+    @contextmanager
+    def progress_listener(self, listener):
+        """ Reports downloads started by this thread to listener(completed, failed) """
+        previous = getattr(self._listeners, 'listener', None)
+        self._listeners.listener = listener
+        try:
+            yield
+        finally:
+            self._listeners.listener = previous
+
+    def download_uri(self, uri: str) -> bool:
+        """ Downloads whatever a Spotify URI or URL points at, returns False if it isn't one """
+        if (parsed := helpers.parse_uri(uri)) is None:
+            return False
+        kind, spotify_id = parsed
+
+        if kind == "track":
+            self.download_tracks([(spotify_id,)])
+        elif kind == "artist":
+            self.download_artist_albums(spotify_id)
+        elif kind == "album":
+            self.download_album(spotify_id)
+        elif kind == "playlist":
+            name, _ = self.get_playlist_info(spotify_id)
+            self.download_playlist_songs(spotify_id, name)
+        elif kind == "episode":
+            self.download_episode(spotify_id)
+        elif kind == "show":
+            for episode in self.iter_show_episodes(spotify_id):
+                self.download_episode(episode)
+        return True
+
+    def download_uris(self, uris: list[tuple]) -> None:
+        """ Downloads many (kind, id) pairs from helpers.read_uris as one combined plan """
+        """ tracks, albums, playlists and artists are expanded lazily into a single run of """
+        """ download_tracks, which resumes where it stopped if the same list is run again """
+        # Podcasts don't go through the track pipeline. They're picked out here rather than in plan(),
+        # which a resumed run never calls
+        podcasts = [(kind, spotify_id) for kind, spotify_id in uris if kind in ("episode", "show")]
+
+        def plan():
+            for kind, spotify_id in uris:
+                if kind in ("episode", "show"):
+                    continue
+                try:
+                    if kind == "track":
+                        jobs = [(spotify_id, "")]
+                    elif kind == "album":
+                        artist, _, album_name, _ = self.get_album_name(spotify_id)
+                        jobs = self._album_jobs(artist, album_name, self.get_album_tracks(spotify_id))
+                    elif kind == "playlist":
+                        name, _ = self.get_playlist_info(spotify_id)
+                        jobs = self._playlist_jobs(spotify_id, name)
+                    else:
+                        _, jobs = self.crawl_discography(spotify_id)
+                    # A track listed directly and through its album is downloaded once per folder by download_tracks
+                    yield from jobs
+                except Exception as error:
+                    logger.error(f"Could not expand spotify:{kind}:{spotify_id}: {error}")
+                    print(f"###   SKIPPING: spotify:{kind}:{spotify_id} (COULD NOT BE LISTED)   ###")
+
+        digest = hashlib.sha1("\n".join(f"{kind}:{spotify_id}" for kind, spotify_id in uris).encode()).hexdigest()
+        self.download_tracks(plan(), desc="Bulk", job_key=f"bulk:{digest[:16]}")
+        for kind, spotify_id in podcasts:
+            try:
+                episodes = [spotify_id] if kind == "episode" else self.iter_show_episodes(spotify_id)
+                for episode in episodes:
+                    self.download_episode(episode)
+            except Exception as error:
+                logger.error(f"Could not download spotify:{kind}:{spotify_id}: {error}")
+                print(f"###   SKIPPING: spotify:{kind}:{spotify_id} (COULD NOT BE DOWNLOADED)   ###")
 
     # Podcast Methods
 
     # TODO: Name Outputs
     def get_episode_info(self, episode_id: str) -> (str, str):
         """ Get Podcast Episode Info  """
-        info = json.loads(requests.get(
-            "https://api.spotify.com/v1/episodes/" +
-            episode_id, headers=
-            {
-                "Authorization": f"Bearer {self._client.user_read_email_token()}"
-            }
-        ).text)
+        info = self._api.get("episodes/" + episode_id)
         if "error" in info:
             return None, None
         return helpers.sanitize_data(info["show"]["name"]), helpers.sanitize_data(info["name"])
 
     # TODO: Test Output
+    def iter_show_episodes(self, show_id: str):
+        """ yields episodes of a show as their pages arrive """
+        for episode in self._api.iter_items(f'shows/{show_id}/episodes'):
+            yield episode["id"]
+
     def get_show_episodes(self, show_id: str) -> list[str]:
         """ returns episodes of a show """
-        episodes = []
-        offset = 0
-        limit = 50
-
-        while True:
-            headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-            params = {'limit': limit, 'offset': offset}
-            resp = requests.get(
-                f'https://api.spotify.com/v1/shows/{show_id}/episodes', headers=headers, params=params).json()
-            offset += limit
-            for episode in resp["items"]:
-                episodes.append(episode["id"])
-
-            if len(resp['items']) < limit:
-                break
-        return episodes
+        return list(self.iter_show_episodes(show_id))
 
     def download_episode(self, episode_id: str) -> None:
         """ downloads episode """
-        podcast_name, episode_name = self.get_episode_info(episode_id)
+        with metrics.timer("metadata", kind="episode"):
+            podcast_name, episode_name = self.get_episode_info(episode_id)
         extra_paths = podcast_name + "/"
 
         if podcast_name is None:
             print("###   SKIPPING: (EPISODE NOT FOUND)   ###")
         else:
             filename = podcast_name + " - " + episode_name
+            path = env.ROOT_PODCAST_PATH + extra_paths + filename + ".wav"
+            # Episodes only reach their final path once complete
+            if os.path.isfile(path) and env.SKIP_EXISTING_FILES:
+                print("###   SKIPPING: (EPISODE ALREADY EXISTS) :", filename, "   ###")
+                return
+
+            from tqdm import tqdm
             episode_id = EpisodeId.from_base62(episode_id)
-            stream = self._client.session().content_feeder().load(
-                episode_id, VorbisOnlyAudioQuality(self._client.quality), False, None)
             os.makedirs(env.ROOT_PODCAST_PATH + extra_paths, exist_ok=True)
-
-            total_size = stream.input_stream.size
-            with open(
-                    env.ROOT_PODCAST_PATH +
-                    extra_paths +
-                    filename + ".wav", 'wb') as file, tqdm(
-                desc=filename,
-                total=total_size,
-                unit='B',
-                unit_scale=True,
-                unit_divisor=1024
-            ) as iterable:
-                for _ in range(int(total_size / env.CHUNK_SIZE) + 1):
-                    iterable.update(file.write(
-                        stream.input_stream.stream().read(env.CHUNK_SIZE)))
+            with self._client.lease() as account:
+                with metrics.timer("stream_open", kind="episode"):
+                    stream = self._open_stream(account, episode_id)
+
+                total_size = stream.input_stream.size
+                part = PartialDownload(path, total_size)
+                if part.offset:
+                    logger.info(f"Resuming {filename} from byte {part.offset}")
+                with part, tqdm(
+                    desc=filename,
+                    total=total_size,
+                    initial=part.offset,
+                    unit='B',
+                    unit_scale=True,
+                    unit_divisor=1024
+                ) as iterable, metrics.timer("transfer", kind="episode"):
+                    received = self._transfer(stream, part, part.offset, iterable)
+                metrics.count("bytes", received - part.offset, stage="transfer")
+
+                if not part.complete():
+                    raise RuntimeError(f"{filename} ended after {part.received} of {total_size} bytes")
+            part.finalize()
+
+    def _open_stream(self, account, playable_id):
+        """ Loads a track or episode stream once the stream rate limiter allows it """
+        self._stream_limiter.acquire()
+        try:
+            with self._client.session_errors(account):
+                stream = account.session.content_feeder().load(
+                    playable_id,
+                    VorbisOnlyAudioQuality(account.quality),
+                    False,
+                    None
+                )
+        except Exception:
+            self._stream_limiter.backoff()
+            raise
+        self._stream_limiter.success()
+        return stream
+
+    @staticmethod
+    def _transfer(stream, file, offset: int = 0, progress=None) -> int:
+        """ Copies a loaded librespot stream into file from offset, returns bytes written """
+        total_size = stream.input_stream.size
+        audio = stream.input_stream.stream()
+        if offset:
+            audio.seek(offset)
+        received = offset
+        while received < total_size:
+            chunk = audio.read(min(env.CHUNK_SIZE, total_size - received))
+            if not chunk:
+                break
+            file.write(chunk)
+            received += len(chunk)
+            if progress is not None:
+                progress.update(len(chunk))
+        return received
 
     # Song Methods
 
+    @staticmethod
+    def _parse_song_info(info: dict):
+        """ Converts a track object into the tuple download_track unpacks """
+        artists = []
+        for data in info['artists']:
+            artists.append(helpers.sanitize_data(data['name']))
+        album_name = helpers.sanitize_data(info["name"])
+        name = helpers.sanitize_data(info['name'])
+        image_url = info['album']['images'][0]['url']
+        release_year = info['album']['release_date'].split("-")[0]
+        disc_number = info['disc_number']
+        track_number = info['track_number']
+        scraped_song_id = info['id']
+        is_playable = info['is_playable']
+
+        return (
+            artists,
+            album_name,
+            name,
+            image_url,
+            release_year,
+            disc_number,
+            track_number,
+            scraped_song_id,
+            is_playable)
+
+    def prefetch_song_info(self, song_ids: list[str]) -> None:
+        """ Resolves metadata for pending songs, up to 50 per request """
+        pending = [song_id for song_id in dict.fromkeys(song_ids)
+                   if song_id is not None and song_id not in self._song_info]
+        for batch in helpers.chunks(pending, env.METADATA_BATCH_SIZE):
+            try:
+                tracks = self._api.get(
+                    'tracks', params={'ids': ",".join(batch), 'market': 'from_token'})['tracks']
+            except Exception as error:
+                logger.warning(f"prefetch_song_info - failed to query {len(batch)} songs: {error}")
+                continue
+
+            for song_id, info in zip(batch, tracks):
+                try:
+                    self._song_info[song_id] = self._parse_song_info(info)
+                except Exception:
+                    # Left for get_song_info to query and report on its own
+                    pass
+
     # TODO: Output Typing
     def get_song_info(self, song_id: str):
         """ Retrieves metadata for downloaded songs """
+        if (info := self._song_info.pop(song_id, None)) is not None:
+            return info
         try:
-            info = json.loads(
-                requests.get(
-                    "https://api.spotify.com/v1/tracks?ids=" +
-                    song_id +
-                    '&market=from_token',
-                    headers={
-                        "Authorization": f"Bearer {self._client.user_read_email_token()}"
-                    }).text)['tracks'][0]
-
-            artists = []
-            for data in info['artists']:
-                artists.append(helpers.sanitize_data(data['name']))
-            album_name = helpers.sanitize_data(info["name"])
-            name = helpers.sanitize_data(info['name'])
-            image_url = info['album']['images'][0]['url']
-            release_year = info['album']['release_date'].split("-")[0]
-            disc_number = info['disc_number']
-            track_number = info['track_number']
-            scraped_song_id = info['id']
-            is_playable = info['is_playable']
+            info = self._api.get(
+                'tracks', params={'ids': song_id, 'market': 'from_token'})['tracks'][0]
 
-            return (
-                artists,
-                album_name,
-                name,
-                image_url,
-                release_year,
-                disc_number,
-                track_number,
-                scraped_song_id,
-                is_playable)
+            return self._parse_song_info(info)
         except Exception as error:
             print("###   get_song_info - FAILED TO QUERY METADATA   ###")
             print(error)
@@ -144,12 +311,22 @@ class Spotify():
             output_dir="",
             prefix=False,
             prefix_value='',
+            state=None,
     ) -> None:
-        """ Downloads raw song audio from Spotify """
+        """ Downloads raw song audio from Spotify, raising if it fails so download_tracks can retry it """
+        """ state(name, error=None) is told when the track starts transcoding and when it's done or failed """
+        state = state or (lambda name, error=None: None)
+        if existing := self._existing_download(track_id, output_dir):
+            print("###   SKIPPING: (SONG ALREADY EXISTS) :", os.path.basename(existing), "   ###")
+            metrics.count("skipped", reason="exists")
+            state("done")
+            return
+
         try:
             # TODO: ADD disc_number IF > 1 
-            artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable = self.get_song_info(
-                track_id)
+            with metrics.timer("metadata", kind="track"):
+                info = self.get_song_info(track_id)
+            artists, album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable = info
 
             _artist = artists[0]
             if prefix:
@@ -164,62 +341,213 @@ class Spotify():
             print(
                 f" download_track FAILED: [{track_id}][{output_dir}][{prefix}][{prefix_value}]")
             print("SKIPPING SONG: ", error)
-            time.sleep(60)
-            # TODO: Check if this is correct
-            self.download_track(track_id, output_dir, prefix=prefix, prefix_value=prefix_value)
+            metrics.count("errors", stage="metadata")
+            raise
         else:
+            target, claim = None, None
             try:
                 if not is_playable:
                     print("###   SKIPPING:", song_name, "(SONG IS UNAVAILABLE)   ###")
+                    metrics.count("skipped", reason="unavailable")
+                    state("done")
                 else:
                     if os.path.isfile(filename) and os.path.getsize(filename) and env.SKIP_EXISTING_FILES:
                         print("###   SKIPPING: (SONG ALREADY EXISTS) :", song_name, "   ###")
+                        # Files from before the manifest existed are recorded the first time they're seen
+                        self._manifest.record(
+                            [track_id, scraped_song_id], env.MUSIC_FORMAT, output_dir, filename)
+                        metrics.count("skipped", reason="exists")
+                        state("done")
                     else:
+                        requested_id = track_id
                         if track_id != scraped_song_id:
                             track_id = scraped_song_id
 
-                        stream = self._client.session().content_feeder().load(
-                            TrackId.from_base62(track_id),
-                            VorbisOnlyAudioQuality(self._client.quality),
-                            False,
-                            None
-                        )
-                        os.makedirs(os.path.join(env.ROOT_PATH, output_dir), exist_ok=True)
-                        total_size = stream.input_stream.size
-
-                        with open(filename, 'wb') as file:
-                            for _ in range(int(total_size / env.CHUNK_SIZE) + 1):
-                                file.write(stream.input_stream.stream().read(env.CHUNK_SIZE))
-
+                        if self._store.enabled:
+                            # The folder gets a link to the track's one canonical file
+                            target, filename = filename, self._store.path(track_id)
+                            claim = self._store.acquire(track_id)
+                            if os.path.isfile(filename) and os.path.getsize(filename):
+                                self._link_track([requested_id, track_id], output_dir, filename, target)
+                                self._store.release(track_id, claim)
+                                print("###   SKIPPING: (SONG ALREADY IN STORE) :", song_name, "   ###")
+                                metrics.count("skipped", reason="linked")
+                                state("done")
+                                return
+                        os.makedirs(os.path.dirname(filename), exist_ok=True)
+                        tags = helpers.track_tags(artists, name, album_name, release_year,
+                                                  disc_number, track_number, track_id)
+                        artwork = None
                         if not env.RAW_AUDIO_AS_IS:
-                            helpers.convert_audio_format(filename, self._client.quality)
-                            helpers.set_audio_tags(filename, artists, name, album_name,
-                                                   release_year, disc_number, track_number, track_id)
-                            helpers.set_music_thumbnail(filename, image_url)
-
-                        if not env.OVERRIDE_AUTO_WAIT:
-                            # TODO: Add in Random here
-                            time.sleep(env.ANTI_BAN_WAIT_TIME)
+                            with metrics.timer("artwork"):
+                                artwork = self._artwork.get(image_url)
+
+                        part, tagged, quality = self._download_audio(track_id, filename, song_name, tags, artwork)
+
+                        finish = partial(self._finish_track, [requested_id, track_id], output_dir, part, state,
+                                         target=target, claim=claim)
+                        if env.RAW_AUDIO_AS_IS or tagged:
+                            finish(None)
+                        else:
+                            # Transcoding and tagging carry on in the background
+                            part.seal()
+                            state("transcoding")
+                            self._post_processor.submit(
+                                part.part_path,
+                                quality,
+                                not env.STREAM_TRANSCODE,
+                                tags,
+                                artwork,
+                                on_done=finish,
+                            )
             except Exception as e:
+                if claim is not None:
+                    self._store.release(track_id, claim)
                 print(e)
                 print("###   SKIPPING:", song_name, "(GENERAL DOWNLOAD ERROR)   ###")
-                if os.path.exists(filename):
-                    os.remove(filename)
+                metrics.count("errors", stage="track")
                 print(
                     f" download_track GENERAL DOWNLOAD ERROR: [{track_id}][{output_dir}][{prefix}][{prefix_value}]")
-                self.download_track(
-                    track_id,
-                    output_dir,
-                    prefix=prefix,
-                    prefix_value=prefix_value
-                )
+                raise
+
+    def _download_audio(self, track_id: str, filename: str, song_name: str, tags: dict, artwork: bytes):
+        """ Streams a track into its .part file on a leased session """
+        """ returns the part, whether the encoder already tagged it and the quality it was fetched in """
+        with self._client.lease() as account:
+            with metrics.timer("stream_open", kind="track"):
+                stream = self._open_stream(account, TrackId.from_base62(track_id))
+            total_size = stream.input_stream.size
+            tagged = False
+
+            # Raw downloads resume from their last chunk, encoded output starts over
+            resumable = env.RAW_AUDIO_AS_IS or not env.STREAM_TRANSCODE
+            part = PartialDownload(filename, total_size, resumable=resumable)
+            if resumable:
+                if part.offset:
+                    logger.info(f"Resuming {song_name} from byte {part.offset}")
+                with part, metrics.timer("transfer", kind="track"):
+                    received = self._transfer(stream, part, part.offset)
+            else:
+                part.discard()
+                # Encoding happens as the stream arrives, so it's timed with the transfer
+                with metrics.timer("transfer_transcode", kind="track"), \
+                        StreamingEncoder(part.part_path, account.quality, tags=tags, artwork=artwork) as file:
+                    received = self._transfer(stream, file)
+                tagged = file.tagged
+            metrics.count("bytes", received - part.offset, stage="transfer")
+
+            if received < total_size:
+                raise RuntimeError(f"stream ended after {received} of {total_size} bytes")
+        return part, tagged, account.quality
+
+    def _finish_track(self, track_ids: list[str], output_dir: str, part: PartialDownload, state, error,
+                      target: str = None, claim=None) -> None:
+        """ Moves a post-processed track into place, or removes it if post-processing failed """
+        """ with a target the track went to the content store and target is linked to it """
+        try:
+            if error is not None:
+                print(error)
+                print("###   SKIPPING:", os.path.basename(target or part.filename), "(POST-PROCESSING ERROR)   ###")
+                part.discard()
+                state("failed", error)
+                return
+            part.finalize()
+            if target is None:
+                self._manifest.record(track_ids, env.MUSIC_FORMAT, output_dir, part.filename)
+            else:
+                try:
+                    self._link_track(track_ids, output_dir, part.filename, target)
+                except OSError as error:
+                    print("###   SKIPPING:", os.path.basename(target), "(LINK ERROR)", error, "   ###")
+                    state("failed", error)
+                    return
+            state("done")
+        finally:
+            if claim is not None:
+                self._store.release(track_ids[-1], claim)
+
+    def _link_track(self, track_ids: list[str], output_dir: str, canonical: str, target: str) -> None:
+        """ Materialises a stored track in its folder and records it there """
+        with metrics.timer("link", mode=self._store.mode):
+            path = self._store.materialize(canonical, target, output_dir)
+        self._manifest.record(track_ids, env.MUSIC_FORMAT, output_dir, path)
+
+    def _existing_download(self, track_id: str, output_dir: str = ""):
+        """ Returns the path of a finished download that should be skipped, or None """
+        if not env.SKIP_EXISTING_FILES:
+            return None
+        return self._manifest.get(track_id, env.MUSIC_FORMAT, output_dir)
+
+    def download_tracks(self, jobs, desc: str = None, total: int = None, job_key: str = None) -> list[dict]:
+        """ Downloads tracks concurrently, jobs are download_track argument tuples """
+        """ with a job_key the jobs go through the persistent job queue, and an interrupted """
+        """ run of the same job resumes from there without enumerating jobs again """
+        """ returns the dead letters of tracks that failed every attempt """
+        jobs = self._unique_jobs(jobs)
+        if job_key is None:
+            entries = ((None, job) for job in jobs)
+        else:
+            entries = self._jobs.track(job_key, jobs)
+
+        # Raises if the same job is already running, e.g. one URI posted twice to the web API
+        with self._jobs.running(job_key) if job_key is not None else nullcontext(), \
+                DownloadScheduler(desc=desc, total=total,
+                                  status=lambda: {'transcoding': self._post_processor.backlog},
+                                  listener=getattr(self._listeners, 'listener', None)) as scheduler:
+            for batch in helpers.chunks(entries, env.METADATA_BATCH_SIZE):
+                self.prefetch_song_info(
+                    [job[0] for _, job in batch if not self._existing_download(*job[:2])])
+                for seq, job in batch:
+                    if seq is None:
+                        scheduler.submit(self.download_track, *job, state=scheduler.job_state(job[0]))
+                    else:
+                        state = scheduler.job_state(job[0], partial(self._jobs.set_state, job_key, seq))
+                        scheduler.submit(self._download_queued, job_key, seq, job, state, key=job[0],
+                                         on_failure=partial(self._jobs.set_state, job_key, seq, "failed"))
+
+        if scheduler.dead_letters:
+            self._report_dead_letters(desc or job_key, scheduler.dead_letters)
+        return scheduler.dead_letters
+
+    @staticmethod
+    def _unique_jobs(jobs):
+        """ Yields jobs, dropping repeats of a track into the same folder """
+        # e.g. a song added to a playlist twice, whose two downloads would share one .part file
+        seen = set()
+        for job in jobs:
+            target = (job[0], os.path.normpath(job[1] if len(job) > 1 and job[1] else "."))
+            if target not in seen:
+                seen.add(target)
+                yield job
+
+    def _download_queued(self, job_key: str, seq: int, job: tuple, state) -> None:
+        """ Claims a job queue item and downloads it, state keeps the item's state up to date """
+        if not self._jobs.claim(job_key, seq):
+            return
+        try:
+            self.download_track(*job, state=state)
+        except Exception as error:
+            # Back in line for the scheduler's next attempt
+            self._jobs.set_state(job_key, seq, "pending", error)
+            raise
+
+    @staticmethod
+    def _report_dead_letters(job: str, dead_letters: list[dict]) -> None:
+        """ Lists tracks that failed every attempt or post-processing and appends them to DEAD_LETTER_FILE """
+        print(f"\n###   {len(dead_letters)} SONG(S) FAILED   ###")
+        for letter in dead_letters:
+            stage = " (post-processing)" if letter.get('stage') == "post_process" else ""
+            print(f"  {letter['key']}{stage}: {letter['error']}")
+        os.makedirs(os.path.dirname(env.DEAD_LETTER_FILE) or ".", exist_ok=True)
+        with open(env.DEAD_LETTER_FILE, "a", encoding="utf-8") as file:
+            for letter in dead_letters:
+                file.write(json.dumps({'time': time.time(), 'job': job, **letter}) + "\n")
+        print(f"  (listed in {env.DEAD_LETTER_FILE})\n")
 
     # Album Methods
     def get_album_name(self, album_id: str) -> (str, str, str, str):
         """ Returns album name """
-        headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-        response = requests.get(
-            f'https://api.spotify.com/v1/albums/{album_id}', headers=headers).json()
+        response = self._api.get(f'albums/{album_id}')
 
         if match := re.search(r'(\d{4})', response['release_date']):
             return (
@@ -233,126 +561,227 @@ class Spotify():
             helpers.sanitize_data(response['name']),
             response['total_tracks'])
 
-    def get_artist_albums(self, artist_id: str) -> list[str]:
+    def iter_artist_albums(self, artist_id: str, include_groups: str = None):
+        """ Yields every release of an artist in the given groups """
+        return self._api.iter_items(
+            f'artists/{artist_id}/albums',
+            params={'include_groups': include_groups or env.ARTIST_ALBUM_GROUPS, 'market': 'from_token'})
+
+    def get_artist_albums(self, artist_id: str, include_groups: str = None) -> list[dict]:
         """ Returns artist's albums """
-        headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-        resp = requests.get(
-            f'https://api.spotify.com/v1/artists/{artist_id}/albums', headers=headers).json()
-        # Return a list each album's id
-        return [resp['items'][i]['id'] for i in range(len(resp['items']))]
+        return list(self.iter_artist_albums(artist_id, include_groups))
 
-    def get_album_tracks(self, album_id: str) -> list[str]:
-        """ Returns album tracklist """
-        songs = []
-        offset = 0
-        limit = 50
+    def iter_album_tracks(self, album_id: str):
+        """ Yields album tracklist as its pages arrive """
         include_groups = 'album,compilation'
+        return self._api.iter_items(f'albums/{album_id}/tracks', params={'include_groups': include_groups})
 
-        while True:
-            headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-            params = {'limit': limit, 'include_groups': include_groups, 'offset': offset}
-            resp = requests.get(
-                f'https://api.spotify.com/v1/albums/{album_id}/tracks', headers=headers, params=params).json()
-            offset += limit
-            songs.extend(resp['items'])
+    def get_album_tracks(self, album_id: str) -> list[str]:
+        """ Returns album tracklist """
+        return list(self.iter_album_tracks(album_id))
 
-            if len(resp['items']) < limit:
-                break
+    @staticmethod
+    def _album_jobs(artist: str, album_name: str, tracks: list[dict]) -> list[tuple]:
+        """ Returns the download_track jobs of an album, split into CD folders if needed """
+        disc_number_flag = any(track['disc_number'] > 1 for track in tracks)
 
-        return songs
+        jobs = []
+        for n, track in enumerate(tracks, start=1):
+            if disc_number_flag:
+                disc_number = str(track['disc_number']).zfill(2)
+                output_dir = os.path.join(f"{artist}", f"{album_name}", f"CD {disc_number}")
+            else:
+                output_dir = os.path.join(f"{artist}", f"{album_name}")
+            jobs.append((track['id'], output_dir, True, str(n)))
+        return jobs
 
     def download_album(self, album_id: str) -> None:
         """ Downloads songs from an album """
-        disc_number_flag = False
         artist, album_release_date, album_name, total_tracks = self.get_album_name(album_id)
         tracks = self.get_album_tracks(album_id)
 
         print(f"\n  {artist} - ({album_release_date}) {album_name} [{total_tracks}]")
 
-        for track in tracks:
-            if track['disc_number'] > 1:
-                disc_number_flag = True
-        if disc_number_flag:
-            for n, track in tqdm(enumerate(tracks, start=1), unit_scale=True, unit='Song', total=len(tracks)):
-                disc_number = str(track['disc_number']).zfill(2)
-                self.download_track(
-                    track['id'],
-                    os.path.join(f"{artist}", f"{album_name}", f"CD {disc_number}"),
-                    prefix=True,
-                    prefix_value=str(n)
-                )
-        else:
-            for n, track in tqdm(enumerate(tracks, start=1), unit_scale=True, unit='Song', total=len(tracks)):
-                self.download_track(
-                    track['id'],
-                    os.path.join(f"{artist}", f"{album_name}"),
-                    prefix=True,
-                    prefix_value=str(n)
-                )
+        jobs = self._album_jobs(artist, album_name, tracks)
+        self.download_tracks(jobs, desc=album_name, total=len(jobs))
+
+    @staticmethod
+    def _release_key(album: dict) -> tuple:
+        """ Returns what regional duplicates of the same release have in common """
+        return (helpers.sanitize_data(album['name']).casefold().strip(), album['total_tracks'])
+
+    def crawl_discography(self, artist_id: str, include_groups: str = None) -> (list[dict], list[tuple]):
+        """ Returns an artist's deduplicated releases and one ordered plan of their tracks """
+        releases = {}
+        for album in self.iter_artist_albums(artist_id, include_groups):
+            # Releases arrive grouped album, single, compilation, appears_on,
+            # so the first of a set of duplicates is the most canonical one
+            releases.setdefault(self._release_key(album), album)
+        albums = list(releases.values())
+
+        with ThreadPoolExecutor(max_workers=env.PAGINATION_WORKERS,
+                                thread_name_prefix="discography") as executor:
+            tracklists = list(executor.map(lambda album: self.get_album_tracks(album['id']), albums))
+
+        plan = []
+        planned = set()
+        for album, tracks in zip(albums, tracklists):
+            jobs = self._album_jobs(album['artists'][0]['name'], helpers.sanitize_data(album['name']), tracks)
+            for job, track in zip(jobs, tracks):
+                # Compilations repeat recordings already planned from their original album under new track IDs
+                keys = {job[0], self._recording_key(track)}
+                if planned.isdisjoint(keys):
+                    planned.update(keys)
+                    plan.append(job)
+        return albums, plan
+
+    @staticmethod
+    def _recording_key(track: dict) -> tuple:
+        """ Returns what identifies a recording across the releases it appears on """
+        """ the same song gets a different track ID on every album, so it's matched on its """
+        """ name, artists and length to the second """
+        name = re.sub(r"\s+", " ", track['name']).strip().casefold()
+        artists = tuple(sorted(artist['id'] for artist in track['artists']))
+        return name, artists, round(track['duration_ms'] / 1000)
+
+    @staticmethod
+    def print_album_list(albums: list[dict]) -> None:
+        """ Prints a numbered list of releases """
+        for i, album in enumerate(albums, start=1):
+            # Release dates start with the year whatever their precision
+            year = album['release_date'][:4]
+            print(
+                f" {i} {album['artists'][0]['name']} - ({year}) {album['name']} [{album['total_tracks']}] [{album['album_type']}]")
 
-    def download_artist_albums(self, artist_id: str) -> None:
+    def download_artist_albums(self, artist_id: str, include_groups: str = None) -> None:
         """ Downloads albums of an artist """
-        albums = self.get_artist_albums(artist_id)
-        for album_id in albums:
-            self.download_album(album_id)
+        job_key = f"artist:{artist_id}:{include_groups or env.ARTIST_ALBUM_GROUPS}"
+        if self._jobs.is_planned(job_key):
+            # An interrupted run left the plan behind, no need to crawl again
+            self.download_tracks((), desc="Discography", job_key=job_key)
+            return
+        albums, plan = self.crawl_discography(artist_id, include_groups)
+        print(f"\n  {len(albums)} release(s), {len(plan)} track(s)")
+        self.download_tracks(plan, desc="Discography", total=len(plan), job_key=job_key)
 
     # Playlist Methods
 
+    def iter_playlist_songs(self, playlist_id: str, params: dict = None, bypass_cache: bool = False):
+        """ yields songs in a playlist as their pages arrive """
+        return self._api.iter_items(f'playlists/{playlist_id}/tracks', params, limit=100, bypass_cache=bypass_cache)
+
     def get_playlist_songs(self, playlist_id: str) -> list[str]:
         """ returns list of songs in a playlist """
-        songs = []
-        offset = 0
-        limit = 100
-        while True:
-            headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-            params = {'limit': limit, 'offset': offset}
-            resp = requests.get(
-                f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks', headers=headers, params=params).json()
-            offset += limit
-            songs.extend(resp['items'])
-
-            if len(resp['items']) < limit:
-                break
-        return songs
+        return list(self.iter_playlist_songs(playlist_id))
 
     def get_playlist_info(self, playlist_id: str) -> (str, str):
         """ Returns information scraped from playlist """
-        headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-        resp = requests.get(
-            f'https://api.spotify.com/v1/playlists/{playlist_id}?fields=name,owner(display_name)&market=from_token',
-            headers=headers).json()
+        resp = self._api.get(
+            f'playlists/{playlist_id}', params={'fields': 'name,owner(display_name)', 'market': 'from_token'})
         return resp['name'].strip(), resp['owner']['display_name'].strip()
 
     # TODO: This could do with some refactoring..
     def download_playlist(self, playlists, playlist_choice):
         """Downloads all the songs from a playlist"""
-        playlist_songs = self.get_playlist_songs(
-            playlists[int(playlist_choice) - 1]['id'])
+        playlist = playlists[int(playlist_choice) - 1]
+        self.download_playlist_songs(playlist['id'], playlist['name'])
+
+    def _playlist_jobs(self, playlist_id: str, playlist_name: str):
+        """ Yields the download_track jobs of a playlist's available songs as its pages arrive """
+        output_dir = helpers.sanitize_data(playlist_name.strip()) + "/"
+        for song in self.iter_playlist_songs(playlist_id):
+            if song['track'] and song['track']['id'] is not None:
+                yield song['track']['id'], output_dir
+
+    def download_playlist_songs(self, playlist_id: str, playlist_name: str) -> None:
+        """ Downloads every available song of a playlist into its own folder """
+        # Downloads start as soon as the first page of the playlist arrives
+        jobs = self._playlist_jobs(playlist_id, playlist_name)
+        self.download_tracks(jobs, desc=playlist_name.strip(), job_key=f"playlist:{playlist_id}")
+
+    def get_playlist_snapshot(self, playlist_id: str) -> (str, str):
+        """ Returns a playlist's name and current snapshot_id, always asking Spotify """
+        resp = self._api.get(f'playlists/{playlist_id}', params={'fields': 'name,snapshot_id'}, bypass_cache=True)
+        return resp['name'].strip(), resp['snapshot_id']
+
+    def sync_playlists(self, playlist_ids: list[str] = None, prune: bool = None) -> None:
+        """ Brings playlists up to date, every saved playlist if no IDs are given """
+        """ unchanged playlists cost a single request, or none beyond listing the saved ones """
+        prune = env.SYNC_PRUNE if prune is None else prune
+        if playlist_ids:
+            def requested():
+                for playlist_id in playlist_ids:
+                    name, snapshot_id = self.get_playlist_snapshot(playlist_id)
+                    yield {'id': playlist_id, 'name': name, 'snapshot_id': snapshot_id}
+            playlists = requested()
+        else:
+            # Saved playlists come with their snapshot_id, 50 to a page
+            playlists = self._api.iter_items('me/playlists', bypass_cache=True)
 
-        for song in playlist_songs:
-            if song['track']['id'] is not None:
-                self.download_track(song['track']['id'], helpers.sanitize_data(
-                    playlists[int(playlist_choice) - 1]['name'].strip()) + "/")
-            print("\n")
+        synced = unchanged = 0
+        for playlist in playlists:
+            if self.sync_playlist(playlist['id'], playlist['name'], playlist['snapshot_id'], prune):
+                synced += 1
+            else:
+                unchanged += 1
+        print(f"\n  {synced} playlist(s) synced, {unchanged} unchanged")
+
+    def sync_playlist(self, playlist_id: str, playlist_name: str, snapshot_id: str, prune: bool = False) -> bool:
+        """ Downloads the songs added to a playlist since its last sync, removing the removed ones if prune """
+        """ returns False if the playlist hadn't changed """
+        playlist_name = playlist_name.strip()
+        output_dir = helpers.sanitize_data(playlist_name) + "/"
+        stored = self._snapshots.get(playlist_id)
+        if stored is not None and stored == (snapshot_id, output_dir):
+            print("###   SKIPPING: (PLAYLIST UNCHANGED) :", playlist_name, "   ###")
+            metrics.count("skipped", reason="unchanged")
+            return False
+
+        # A renamed playlist goes to a new folder, so everything is compared against nothing
+        previous = self._snapshots.tracks(playlist_id) if stored is not None and stored[1] == output_dir else set()
+        with metrics.timer("metadata", kind="playlist"):
+            current = list(dict.fromkeys(
+                song['track']['id'] for song in self.iter_playlist_songs(
+                    playlist_id, {'fields': 'items(track(id)),total'}, bypass_cache=True)
+                if song['track'] and song['track']['id'] is not None))
+        added = [track_id for track_id in current if track_id not in previous]
+        removed = previous.difference(current)
+        print(f"\n  {playlist_name}: {len(added)} added, {len(removed)} removed")
+
+        # download_tracks only returns once every track is transcoded and tagged, so its dead letters
+        # include tracks whose post-processing failed and whose file was thrown away
+        dead_letters = self.download_tracks(
+            ((track_id, output_dir) for track_id in added), desc=playlist_name, total=len(added),
+            job_key=f"sync:{playlist_id}:{snapshot_id}")
+        failed = {dead_letter['key'] for dead_letter in dead_letters}
+
+        if prune:
+            self._prune_tracks(removed, output_dir)
+            removed = set()
+        # Removed songs that were kept stay on the list, so a later sync with prune still finds them.
+        # Failed songs are left off it and the snapshot isn't trusted, so the next sync retries them
+        self._snapshots.save(playlist_id, None if failed else snapshot_id, playlist_name, output_dir,
+                             [track_id for track_id in current if track_id not in failed] + sorted(removed))
+        return True
+
+    def _prune_tracks(self, track_ids, output_dir: str) -> None:
+        """ Removes tracks from a folder and forgets them there """
+        for track_id in track_ids:
+            if path := self._manifest.get(track_id, env.MUSIC_FORMAT, output_dir):
+                self._store.remove(path, output_dir)
+                print("###   REMOVED:", os.path.basename(path), "(NO LONGER IN PLAYLIST)   ###")
+                metrics.count("pruned")
+            self._manifest.forget(track_id, env.MUSIC_FORMAT, output_dir)
 
     # User Methods
 
+    def iter_user_playlists(self):
+        """ Yields users playlists as their pages arrive """
+        return self._api.iter_items('me/playlists')
+
     def get_user_playlists(self) -> list[str]:
         """ Returns list of users playlists """
-        playlists = []
-        limit = 50
-        offset = 0
-        while True:
-            headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-            params = {'limit': limit, 'offset': offset}
-            resp = requests.get("https://api.spotify.com/v1/me/playlists",
-                                headers=headers, params=params).json()
-            offset += limit
-            playlists.extend(resp['items'])
-
-            if len(resp['items']) < limit:
-                break
-        return playlists
+        return list(self.iter_user_playlists())
 
     def download_from_user_playlist(self):
         """ Select which playlist(s) to download """
@@ -377,50 +806,39 @@ class Spotify():
 
             print(f"Downloading from {start} to {end}...")
 
-            for playlist in range(start, end):
-                self.download_playlist(playlists, playlist)
+            chosen = [playlists[choice - 1] for choice in range(start, end)]
+            # One plan for the whole range, so an interrupted run resumes across playlists
+            jobs = (job for playlist in chosen for job in self._playlist_jobs(playlist['id'], playlist['name']))
+            self.download_tracks(jobs, desc="Playlists",
+                                 job_key="playlists:" + ",".join(playlist['id'] for playlist in chosen))
 
             print("\n**All playlists have been downloaded**\n")
 
+    def iter_saved_tracks(self):
+        """ Yields user's saved tracks as their pages arrive """
+        # TODO: 403 Insufficient Client Scope... On test user
+        return self._api.iter_items('me/tracks')
+
     def get_saved_tracks(self) -> list[str]:
         """ Returns user's saved tracks """
-        songs = []
-        offset = 0
-        limit = 50
-
-        logger.debug(self._client.session().tokens().get_token())
-
-        while True:
-            headers = {'Authorization': f'Bearer {self._client.user_read_email_token()}'}
-            params = {'limit': limit, 'offset': offset}
-            resp = requests.get('https://api.spotify.com/v1/me/tracks',
-                                headers=headers, params=params).json()
-            logger.debug(resp)
-            # TODO: 403 Insufficient Client Scope... On test user
-            offset += limit
-            songs.extend(resp['items'])
-
-            if len(resp['items']) < limit:
-                break
-        return songs
+        return list(self.iter_saved_tracks())
 
     def _search_by_type(self, search: str, types: list[str]) -> dict:
         """ Searches Spotify's API for artists """
-        resp = requests.get(
-            "https://api.spotify.com/v1/search",
+        resp = self._api.get(
+            "search",
             {
                 "limit": env.LIMIT,
                 "offset": "0",
                 "q": search,
                 "type": str(",".join(map(str, types))),
             },
-            headers={"Authorization": f"Bearer {self._client.user_read_email_token()}"},
         )
 
         items = {}
         for type_str in types:
             # TODO: This is the dodgiest fix possible
-            items[type_str] = resp.json()[type_str + "s"]["items"]
+            items[type_str] = resp[type_str + "s"]["items"]
 
         return items
 
@@ -434,20 +852,19 @@ class Spotify():
         # TODO: Investigate breaking this up a bit..
 
         # Does a Generic Search
-        resp = requests.get(
-            "https://api.spotify.com/v1/search",
+        resp = self._api.get(
+            "search",
             {
                 "limit": env.LIMIT,
                 "offset": "0",
                 "q": search_term,
                 "type": "track,album,playlist,artist"
             },
-            headers={"Authorization": f"Bearer {self._client.user_read_email_token()}"},
         )
 
         # Gets Tracks from Search
         i = 1
-        tracks = resp.json()["tracks"]["items"]
+        tracks = resp["tracks"]["items"]
         if len(tracks) > 0:
             print("###  TRACKS  ###")
             for track in tracks:
@@ -462,7 +879,7 @@ class Spotify():
         else:
             total_tracks = 0
 
-        albums = resp.json()["albums"]["items"]
+        albums = resp["albums"]["items"]
         if len(albums) > 0:
             print("###  ALBUMS  ###")
             for album in albums:
@@ -476,7 +893,7 @@ class Spotify():
         else:
             total_albums = 0
 
-        playlists = resp.json()["playlists"]["items"]
+        playlists = resp["playlists"]["items"]
         total_playlists = 0
         print("###  PLAYLISTS  ###")
         for playlist in playlists:
@@ -485,7 +902,7 @@ class Spotify():
         total_playlists = i - total_albums - total_tracks - 1
         print("\n")
 
-        artists = resp.json()["artists"]["items"]
+        artists = resp["artists"]["items"]
         helpers.print_artist_list(artists, i)
         total_artists = len(artists)
         i += total_artists
@@ -504,7 +921,7 @@ class Spotify():
                 position = int(pos)
                 if position <= total_tracks:
                     track_id = tracks[position - 1]["id"]
-                    self.download_track(track_id)
+                    self.download_tracks([(track_id,)])
                 elif position <= total_albums + total_tracks:
                     # print("==>" , position , " total_albums + total_tracks ", total_albums + total_tracks )
                     self.download_album(albums[position - total_tracks - 1]["id"])
@@ -512,46 +929,16 @@ class Spotify():
                     # print("==> position: ", position ," total_albums + total_tracks + total_playlists ", total_albums + total_tracks + total_playlists )
                     playlist_choice = playlists[position -
                                                 total_tracks - total_albums - 1]
-                    playlist_songs = self.get_playlist_songs(playlist_choice['id'])
-                    for song in playlist_songs:
-                        if song['track']['id'] is not None:
-                            self.download_track(song['track']['id'], helpers.sanitize_data(
-                                playlist_choice['name'].strip()) + "/")
-                            print("\n")
+                    self.download_playlist_songs(playlist_choice['id'], playlist_choice['name'])
                 else:
                     # 5eyTLELpc4Coe8oRTHkU3F
                     # print("==> position: ", position ," total_albums + total_tracks + total_playlists: ", position - total_albums - total_tracks - total_playlists )
                     artists_choice = artists[position - total_albums - total_tracks - total_playlists - 1]
-                    albums = self.get_artist_albums(artists_choice['id'])
-                    i = 0
+                    artist_albums, plan = self.crawl_discography(artists_choice['id'], 'album,compilation')
 
                     print("\n")
-                    print("ALL ALBUMS: ", len(albums), " IN:", str(set(album['album_type'] for album in albums)))
-
-                    for album in albums:
-                        if artists_choice['id'] == album['artists'][0]['id'] and album['album_type'] != 'single':
-                            i += 1
-                            year = re.search('(\d{4})', album['release_date']).group(1)
-                            print(
-                                f" {i} {album['artists'][0]['name']} - ({year}) {album['name']} [{album['total_tracks']}] [{album['album_type']}]")
-                    total_albums_downloads = i
-                    print("\n")
-
-                    # print('\n'.join([f"{album['name']} - [{album['album_type']}] | {'/'.join([artist['name'] for artist in album['artists']])} " for album in sorted(albums, key=lambda k: k['album_type'], reverse=True)]))
-
-                    for i in range(8)[::-1]:
-                        print("\rWait for Download in %d second(s)..." % (i + 1), end="")
-                        time.sleep(1)
-
+                    print("ALL ALBUMS: ", len(artist_albums), " IN:",
+                          str(set(album['album_type'] for album in artist_albums)))
+                    self.print_album_list(artist_albums)
                     print("\n")
-                    i = 0
-                    for album in albums:
-                        if artists_choice['id'] == album['artists'][0]['id'] and album['album_type'] != 'single':
-                            i += 1
-                            year = re.search('(\d{4})', album['release_date']).group(1)
-                            print(
-                                f"\n\n\n{i}/{total_albums_downloads} {album['artists'][0]['name']} - ({year}) {album['name']} [{album['total_tracks']}]")
-                            self.download_album(album['id'])
-                            for i in range(env.ANTI_BAN_WAIT_TIME_ALBUMS)[::-1]:
-                                print("\rWait for Next Download in %d second(s)..." % (i + 1), end="")
-                                time.sleep(1)
+                    self.download_tracks(plan, desc=artists_choice['name'], total=len(plan))
@@ -0,0 +1,82 @@
+"""
+Transcode
+This file contains the streaming encoder that pipes downloaded Ogg Vorbis
+chunks straight into ffmpeg, so each track is written to disk only once.
+
+"""
+import os
+import subprocess
+import tempfile
+from contextlib import ExitStack
+
+import helpers
+import load_env as env
+
+
+class StreamingEncoder:
+    """ File-like ffmpeg pipe that encodes Ogg Vorbis chunks as they arrive """
+
+    def __init__(self, filename: str, quality, music_format: str = None, tags: dict = None,
+                 artwork: bytes = None):
+        self.filename = filename
+        self.music_format = music_format or env.MUSIC_FORMAT
+        self.bitrate = helpers.audio_bitrate(quality)
+        self.tags = tags or {}
+        self.artwork = artwork if helpers.encoder_embeds_artwork(self.music_format) else None
+        # True when the output needs no tagging pass afterwards
+        self.tagged = bool(tags) and (self.artwork is not None or not artwork)
+        self._process: subprocess.Popen = None
+        self._errors = None
+        self._resources = ExitStack()
+
+    def _command(self, cover: str = None) -> list[str]:
+        command = [env.FFMPEG, "-hide_banner", "-loglevel", "error", "-y", "-f", "ogg", "-i", "pipe:0"]
+        if cover is not None:
+            command += ["-i", cover, "-map", "0:a", "-map", "1:0", "-c:v", "copy", "-id3v2_version", "3",
+                        "-metadata:s:v", "title=Album cover", "-metadata:s:v", "comment=Cover (front)"]
+        else:
+            command += ["-vn"]
+        for key, value in helpers.encoder_metadata(self.tags).items():
+            command += ["-metadata", f"{key}={value}"]
+        return command + ["-b:a", self.bitrate, "-f", self.music_format, self.filename]
+
+    def __enter__(self):
+        # A file rather than a pipe, so a chatty ffmpeg can't block on stderr
+        self._errors = self._resources.enter_context(tempfile.TemporaryFile())
+        try:
+            cover = self._resources.enter_context(helpers.artwork_file(self.artwork))
+            self._process = subprocess.Popen(
+                self._command(cover),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=self._errors,
+            )
+        except BaseException:
+            self._resources.close()
+            raise
+        return self
+
+    def write(self, chunk: bytes) -> int:
+        """ Feeds a chunk of the Ogg stream to the encoder """
+        self._process.stdin.write(chunk)
+        return len(chunk)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is not None:
+                self._process.kill()
+                self._process.wait()
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                return False
+
+            self._process.stdin.close()
+            if self._process.wait() != 0:
+                self._errors.seek(0)
+                message = self._errors.read().decode(errors="replace").strip()
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                raise RuntimeError(f"ffmpeg exited with {self._process.returncode}: {message}")
+        finally:
+            self._resources.close()
+        return False
@@ -0,0 +1,201 @@
+"""
+Web Server
+This file contains the resident download service, which keeps one
+authenticated Spotify instance warm and runs jobs submitted over a local
+HTTP API.
+
+    POST /jobs        {"uri": "spotify:album:..."} or {"uris": [...]}
+    GET  /jobs        status of every job
+    GET  /jobs/<id>   status of one job
+    GET  /health      liveness check
+    GET  /metrics     Prometheus metrics, when METRICS is on
+
+"""
+import json
+import time
+import queue
+import threading
+import itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+import helpers
+import load_env as env
+import metrics
+
+
+class Job:
+    """ One submitted download and its progress """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, uri: str):
+        self.id = next(self._ids)
+        self.uri = uri
+        self.state = "queued"
+        self.error = None
+        self.completed = 0
+        self.failed = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def progress(self, completed: int, failed: int) -> None:
+        """ Progress listener for the job's downloads """
+        self.completed = completed
+        self.failed = failed
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "uri": self.uri,
+            "state": self.state,
+            "error": self.error,
+            "completed": self.completed,
+            "failed": self.failed,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobRunner:
+    """ Shared queue of jobs worked through by a few threads """
+
+    def __init__(self, api, workers: int = None, history: int = None):
+        self._api = api
+        self._queue = queue.Queue()
+        # Job ID -> Job in submission order, finished ones beyond history are forgotten
+        self._jobs = {}
+        self._history = env.WEB_JOB_HISTORY if history is None else history
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-{n}", daemon=True)
+            for n in range(workers or env.WEB_JOB_WORKERS)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, uri: str) -> Job:
+        """ Queues a download job """
+        job = Job(uri)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._queue.put(job)
+        logger.info(f"Job {job.id} queued: {uri}")
+        return job
+
+    def get(self, job_id: int):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.state = "running"
+            job.started = time.time()
+            try:
+                with self._api.progress_listener(job.progress):
+                    self._api.download_uri(job.uri)
+            except Exception as error:
+                job.state = "failed"
+                job.error = str(error)
+                logger.error(f"Job {job.id} failed: {error}")
+            else:
+                job.state = "done"
+                logger.info(f"Job {job.id} done: {job.uri}")
+            finally:
+                job.finished = time.time()
+                self._expire()
+                self._queue.task_done()
+
+    def _expire(self) -> None:
+        """ Forgets the oldest finished jobs beyond the history size """
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished is not None]
+            for job_id in finished[:max(0, len(finished) - self._history)]:
+                del self._jobs[job_id]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """ JSON API over the job runner """
+
+    runner: JobRunner = None
+
+    def _send(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/health":
+            self._send(200, {"status": "ok"})
+        elif path == "/jobs":
+            self._send(200, [job.to_dict() for job in self.runner.jobs()])
+        elif path == "/metrics":
+            if not metrics.enabled():
+                self._send(404, {"error": "metrics are disabled, set METRICS=True"})
+                return
+            data = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif path.startswith("/jobs/") and path[len("/jobs/"):].isdigit():
+            job = self.runner.get(int(path[len("/jobs/"):]))
+            if job is None:
+                self._send(404, {"error": "no such job"})
+            else:
+                self._send(200, job.to_dict())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self._send(400, {"error": "body must be JSON"})
+            return
+        if not isinstance(body, dict):
+            self._send(400, {"error": "body must be a JSON object"})
+            return
+
+        uris = body.get("uris") or ([body["uri"]] if body.get("uri") else [])
+        if not isinstance(uris, list):
+            self._send(400, {"error": "uris must be a list"})
+            return
+        invalid = [uri for uri in uris if not isinstance(uri, str) or helpers.parse_uri(uri) is None]
+        if not uris or invalid:
+            self._send(400, {"error": "expected Spotify track, album, playlist, artist, episode or show URIs",
+                             "invalid": invalid})
+            return
+        self._send(202, [self.runner.submit(uri).to_dict() for uri in uris])
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve(api, host: str = None, port: int = None) -> None:
+    """ Runs the job API until interrupted """
+    handler = type("Handler", (RequestHandler,), {"runner": JobRunner(api)})
+    httpd = ThreadingHTTPServer((host or env.WEB_HOST, port or env.WEB_PORT), handler)
+    logger.info(f"Listening on http://{httpd.server_address[0]}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
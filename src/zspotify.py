@@ -6,22 +6,35 @@ It's like youtube-dl, but for Spotify.
 """
 import sys
 
-import helpers
-import auth
-import spotify_api
 import cli
 
 def main():
     """ Main Function """
+    # Arguments are checked before anything slow is imported or logged into
+    if cli.parse(sys.argv) is None:
+        cli.usage(sys.argv)
+        return
+
+    import helpers
+    import auth
+    import spotify_api
+    import metrics
+
     # Pretty Printout
     helpers.splash()
+    metrics.start()
     
     # Login to Spotify and get the Client
     client = auth.Client()
     spotify = spotify_api.Spotify(client)
 
     # Command Line Argument Given
-    cli.handle(spotify, sys.argv)
+    try:
+        cli.handle(spotify, sys.argv)
+    finally:
+        spotify.close()
+        client.close()
+        metrics.close()
 
 
 if __name__ == "__main__":